@@ -0,0 +1,193 @@
+import hashlib
+import os
+import shutil
+import sys
+import threading
+from pathlib import Path
+from loguru import logger
+import msgpack
+
+FICLONE = 0x40049409
+
+def _reflink(src, dst):
+    import fcntl
+    with open(src, 'rb') as s, open(dst, 'wb') as d:
+        fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+
+def reflink(src, dst):
+    """Clone src to dst sharing the data copy-on-write, returns whether it worked."""
+    if os.path.lexists(dst):
+        os.remove(dst)
+
+    if sys.platform == 'linux':
+        try:
+            _reflink(src, dst)
+            return True
+        except (ImportError, OSError):
+            if os.path.lexists(dst):
+                os.remove(dst)
+    return False
+
+def reflink_or_copy(src, dst):
+    """An independent copy of src at dst, written to dst never changes src."""
+    if not reflink(src, dst):
+        shutil.copy2(src, dst)
+
+def link_or_copy(src, dst):
+    """Mirror src at dst without duplicating data where the filesystem allows.
+
+    Tries a reflink, a hardlink and a symlink in turn, then falls back to a
+    copy. Hardlinks and symlinks share the data with src, only use them for
+    files which are never edited in place.
+    """
+    if reflink(src, dst):
+        return
+
+    for link in (os.link, os.symlink):
+        try:
+            link(src, dst)
+            return
+        except OSError:
+            ...
+
+    shutil.copy2(src, dst)
+
+def get_content_digest(file_path):
+    # 内容寻址需要抗碰撞的哈希
+    digest = hashlib.blake2b(digest_size=16)
+
+    with open(file_path, 'rb') as f:
+        while chunk := f.read(1 << 20):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+class BlobStore:
+    """按内容寻址的资源仓库, 相同的文件只保存一份
+
+    笔记中的资源以 名称->摘要 的形式引用仓库中的文件, 按引用计数回收.
+    笔记目录中的资源可能被编辑, 只能是仓库文件的写时复制或副本;
+    html目录中的资源是指向仓库文件的链接.
+    """
+    VERSION = 1
+
+    def __init__(self, root: Path):
+        self._root = root
+        self._index = root / 'index'
+        self._lock = threading.Lock()
+
+        self._refs: dict[str, dict[str, str]] = {}
+        self._counts: dict[str, int] = {}
+
+        if not os.path.exists(root):
+            os.makedirs(root)
+
+        try:
+            with open(self._index, 'rb') as file:
+                data = msgpack.unpackb(file.read())
+            if data.get('version') == self.VERSION:
+                self._refs = data['notes']
+        except FileNotFoundError:
+            ...
+        except Exception as e:
+            logger.warning(f"load blob index failed: {str(e)}")
+
+        for refs in self._refs.values():
+            for digest in refs.values():
+                self._counts[digest] = self._counts.get(digest, 0) + 1
+
+    def path(self, digest: str):
+        return self._root / digest[:2] / digest
+
+    def refs(self, note_id: str):
+        with self._lock:
+            return dict(self._refs.get(note_id, {}))
+
+    def add(self, note_id: str, name: str, file_path) -> Path:
+        """Store a copy of an external file as the resource name of a note."""
+        digest = get_content_digest(file_path)
+        blob = self.path(digest)
+        with self._lock:
+            if not blob.exists():
+                blob.parent.mkdir(exist_ok=True)
+                shutil.copy2(file_path, blob)
+            self._reference(note_id, name, digest)
+        return blob
+
+    def ingest(self, note_id: str, name: str, file_path) -> Path:
+        """Take over a file which is already in the note folder.
+
+        The blob is a copy of the file, the file shares its data with the
+        blob only through a reflink.
+        """
+        with self._lock:
+            # 旧版本留下的指向仓库文件的硬链接或符号链接, 编辑会改写仓库文件, 先断开
+            old = self._refs.get(note_id, {}).get(name)
+            if old and self._linked(file_path, self.path(old)):
+                temp = Path(f'{file_path}.tmp')
+                shutil.copy2(file_path, temp)
+                os.replace(temp, file_path)
+
+        digest = get_content_digest(file_path)
+        blob = self.path(digest)
+        with self._lock:
+            if not blob.exists():
+                blob.parent.mkdir(exist_ok=True)
+                reflink_or_copy(file_path, blob)
+            else:
+                # 内容已存在时尝试共享数据, 不支持reflink则保留原文件
+                temp = Path(f'{file_path}.tmp')
+                if reflink(blob, temp):
+                    os.replace(temp, file_path)
+            self._reference(note_id, name, digest)
+        return blob
+
+    def release(self, note_id: str, name: str):
+        with self._lock:
+            refs = self._refs.get(note_id, {})
+            digest = refs.pop(name, None)
+            if not refs:
+                self._refs.pop(note_id, None)
+            if digest:
+                self._unreference(digest)
+
+    def release_note(self, note_id: str):
+        with self._lock:
+            for digest in self._refs.pop(note_id, {}).values():
+                self._unreference(digest)
+
+    def save(self):
+        with self._lock:
+            data = msgpack.packb({
+                'version': self.VERSION,
+                'notes': self._refs,
+            })
+        with open(self._index, 'wb') as file:
+            file.write(data) # type: ignore
+
+    def _linked(self, file_path, blob: Path):
+        try:
+            return os.path.islink(file_path) or os.path.samefile(file_path, blob)
+        except OSError:
+            return False
+
+    def _reference(self, note_id: str, name: str, digest: str):
+        refs = self._refs.setdefault(note_id, {})
+        old = refs.get(name)
+        if old == digest:
+            return
+        refs[name] = digest
+        self._counts[digest] = self._counts.get(digest, 0) + 1
+        if old:
+            self._unreference(old)
+
+    def _unreference(self, digest: str):
+        count = self._counts.get(digest, 0) - 1
+        if count > 0:
+            self._counts[digest] = count
+            return
+        self._counts.pop(digest, None)
+        try:
+            os.remove(self.path(digest))
+        except FileNotFoundError:
+            ...
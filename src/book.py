@@ -1,23 +1,61 @@
+import json
 import shutil
+import socket
 import subprocess
 import os
 import re
 import hashlib
+import threading
+import time
+import urllib.request
+import zlib
+from abc import ABC, abstractmethod
+from functools import cache
 from loguru import logger
 import msgpack
 from pathlib import Path
 from uuid import uuid4
-from PySide6.QtCore import QObject, QTimer, QUrl, Signal, Slot
+from PySide6.QtCore import (
+    QFileSystemWatcher,
+    QObject,
+    QRunnable,
+    QThreadPool,
+    QTimer,
+    QUrl,
+    Signal,
+    Slot,
+)
 from platformdirs import user_data_path
 
-def get_file_hash(file_path):
-    hash_sha256 = hashlib.sha256()
+from blobstore import BlobStore, link_or_copy, reflink_or_copy
+from searchindex import SearchIndex
+
+try:
+    # 缺少任一插件时渲染结果与gfm不一致, 整体视为不可用
+    import markdown_it
+    import linkify_it
+    from markdown_it import MarkdownIt
+    from mdit_py_plugins.anchors import anchors_plugin
+    from mdit_py_plugins.tasklists import tasklists_plugin
+except ImportError:
+    markdown_it = MarkdownIt = None
 
+def get_file_state(file_path):
+    """Cheap fingerprint of a file, the content is only hashed when it changes."""
+    stat = os.stat(file_path)
+    return stat.st_mtime_ns, stat.st_size, stat.st_ino
+
+def get_file_hash(file_path):
+    # 只用于检测变动, 不需要密码学哈希, crc32足够快
+    # 不用mmap: windows下映射中的文件不能被编辑器截断或替换
+    crc = 0
+    size = 0
     with open(file_path, 'rb') as f:
-        while chunk := f.read(4096):
-            hash_sha256.update(chunk)
+        while chunk := f.read(1 << 20):
+            crc = zlib.crc32(chunk, crc)
+            size += len(chunk)
 
-    return hash_sha256.hexdigest()
+    return f'{size:x}-{crc:08x}'
 
 def get_file_title(file_path):
     title = ''
@@ -30,14 +68,384 @@ def get_file_title(file_path):
 
     return title
 
+def pandoc_path():
+    return Path.cwd() / 'external' / 'pandoc.exe'
+
+def template_path():
+    return Path.cwd() / 'style' / 'github.html'
+
+@cache
+def get_template_hash():
+    return get_file_hash(template_path())
+
+def fill_template(template: str, variables: dict[str, str]):
+    """Fill the $name$ variables of a pandoc template."""
+    def replace(match):
+        if match.group(0) == '$$':
+            return '$'
+        return variables.get(match.group(1), '')
+    return re.sub(r"\$\$|\$(\w+)\$", replace, template)
+
+def is_list_item(block: str):
+    return re.match(r" {0,3}([-+*]|\d{1,9}[.)])(\s|$)", block) is not None
+
+def add_block(blocks: list[str], block: str):
+    # 空行分隔的列表项属于同一个(松散)列表, 分开渲染会变成多个列表
+    if blocks and is_list_item(block) and is_list_item(blocks[-1]):
+        blocks[-1] += '\n\n' + block
+    else:
+        blocks.append(block)
+
+def heading_slug(title: str):
+    # 与anchors插件(GitHub)的规则相近: 去掉链接地址和标点, 空格转为-
+    title = re.sub(r"\]\([^)]*\)", "", title)
+    return re.sub(r"[^\w\- ]", "", title.strip().lower()).replace(' ', '-')
+
+def split_blocks(text: str) -> list[str] | None:
+    """Split the markdown into top level blocks which render independently.
+
+    Returns None when the blocks depend on each other (link reference
+    definitions, raw html which may span blank lines, headings with the
+    same id, which is numbered across the document), the caller should
+    render the whole document then.
+    """
+    if re.search(r"^ {0,3}\[[^\]]+\]:", text, re.MULTILINE):
+        return None
+
+    blocks = []
+    lines = []
+    fence = ''
+    blank = False
+    slugs = set()
+    previous = ''
+    for line in text.splitlines(keepends=True):
+        if fence:
+            lines.append(line)
+            if re.fullmatch(f"{re.escape(fence[0])}{{{len(fence)},}}", line.strip()):
+                fence = ''
+            continue
+
+        if not line.strip():
+            blank = True
+            previous = ''
+            lines.append(line)
+            continue
+
+        # 分块渲染时各块的标题id各自编号, 重名的标题会得到相同的id
+        title = None
+        match = re.match(r"[ >]*#{1,6}(?:[ \t]+(.*?))?(?:[ \t]+#+)?[ \t]*$", line)
+        if match:
+            title = match.group(1) or ''
+        elif previous and re.fullmatch(r" {0,3}(=+|-+)[ \t]*", line.rstrip('\n')):
+            title = previous
+        if title is not None:
+            slug = heading_slug(title)
+            if slug in slugs:
+                return None
+            slugs.add(slug)
+        previous = line
+
+        # html块可能跨越空行(如<details>), 包在各自的div中会破坏嵌套
+        if re.match(r" {0,3}<[a-zA-Z/!?]", line):
+            return None
+
+        # 空行后顶格的行开始新的块, 缩进的行属于上一个块(列表, 代码)
+        if blank and not line[0].isspace():
+            block = ''.join(lines).strip()
+            if block:
+                add_block(blocks, block)
+            lines = []
+        blank = False
+
+        match = re.match(r" {0,3}(`{3,}|~{3,})", line)
+        if match:
+            fence = match.group(1)
+        lines.append(line)
+
+    block = ''.join(lines).strip()
+    if block:
+        add_block(blocks, block)
+
+    return blocks
+
+def block_keys(blocks: list[str]):
+    """Stable keys of the blocks, identical blocks are told apart by order."""
+    keys = []
+    counts: dict[str, int] = {}
+    for block in blocks:
+        digest = hashlib.blake2b(block.encode('utf-8'), digest_size=8).hexdigest()
+        counts[digest] = counts.get(digest, 0) + 1
+        keys.append(f'{digest}-{counts[digest]}')
+    return keys
+
+def replace_file(temp: Path, output: Path, succeeded: bool):
+    # 先写临时文件再替换, 中途取消的构建不会留下残缺的页面
+    if succeeded:
+        os.replace(temp, output)
+    else:
+        temp.unlink(missing_ok=True)
+    return succeeded
+
+def temp_file(output: Path):
+    return output.with_suffix('.tmp' + output.suffix)
+
+class CancelToken:
+    """取消正在进行的构建, 并终止其中的子进程"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._cancelled = False
+        self._process: subprocess.Popen | None = None
+
+    @property
+    def cancelled(self):
+        return self._cancelled
+
+    def cancel(self):
+        with self._lock:
+            self._cancelled = True
+            if self._process:
+                self._process.terminate()
+
+    def run(self, command: list, **kwargs):
+        """Run a process, returns its exit code or None if cancelled."""
+        with self._lock:
+            if self._cancelled:
+                return None
+            self._process = subprocess.Popen(command, **kwargs)
+        code = self._process.wait()
+        with self._lock:
+            self._process = None
+        return None if self._cancelled else code
+
+class Renderer(ABC):
+    """markdown转html的后端, render可能在工作线程中调用"""
+    # 同时进行的构建数, 子进程渲染可用满所有核
+    MAX_JOBS = os.cpu_count() or 1
+
+    @abstractmethod
+    def version(self) -> str:
+        ...
+
+    @abstractmethod
+    def render(self, source: Path, output: Path,
+               token: CancelToken | None = None) -> bool:
+        ...
+
+    def close(self):
+        ...
+
+class IncrementalRenderer(Renderer):
+    """支持按块渲染的后端"""
+    @abstractmethod
+    def render_fragment(self, text: str) -> str:
+        ...
+
+    @abstractmethod
+    def write_page(self, body: str, output: Path):
+        ...
+
+class PandocRenderer(Renderer):
+    """每次构建启动一个pandoc进程"""
+    def __init__(self):
+        self._version: str | None = None
+
+    def version(self):
+        if self._version is None:
+            try:
+                result = subprocess.run([pandoc_path(), '--version'],
+                    capture_output=True, text=True,
+                    creationflags=subprocess.CREATE_NO_WINDOW)
+                self._version = result.stdout.partition('\n')[0]
+            except OSError as e:
+                logger.warning(f"get pandoc version failed: {str(e)}")
+                self._version = ''
+        return self._version
+
+    def render(self, source: Path, output: Path, token=None):
+        # markdown to html
+        temp = temp_file(output)
+        code = (token or CancelToken()).run([
+            pandoc_path(), 
+            '-s', 
+            str(source), 
+            '-o', 
+            temp, 
+            f'--template={template_path()}',
+            '--from=gfm',
+        ], creationflags=subprocess.CREATE_NO_WINDOW)
+
+        return replace_file(temp, output, code == 0)
+
+class PandocServerRenderer(PandocRenderer):
+    """常驻的pandoc server进程, 通过http接收构建任务, 启动失败时退回子进程"""
+    START_TIMEOUT = 5
+    REQUEST_TIMEOUT = 10
+
+    def __init__(self):
+        super().__init__()
+
+        self._lock = threading.Lock()
+        self._process: subprocess.Popen | None = None
+        self._port = 0
+        self._failed = False
+        self._template = ''
+
+    def _start(self):
+        with self._lock:
+            if self._process and self._process.poll() is None:
+                return True
+            if self._failed:
+                return False
+
+            try:
+                with socket.socket() as sock:
+                    sock.bind(('127.0.0.1', 0))
+                    self._port = sock.getsockname()[1]
+
+                self._template = template_path().read_text(encoding='utf-8')
+                self._process = subprocess.Popen(
+                    [pandoc_path(), 'server', f'--port={self._port}']
+                    , stdout=subprocess.DEVNULL
+                    , stderr=subprocess.DEVNULL
+                    , creationflags=subprocess.CREATE_NO_WINDOW)
+
+                deadline = time.monotonic() + self.START_TIMEOUT
+                while self._process.poll() is None:
+                    try:
+                        socket.create_connection(
+                            ('127.0.0.1', self._port), timeout=0.1).close()
+                        return True
+                    except OSError:
+                        if time.monotonic() > deadline:
+                            break
+                        time.sleep(0.05)
+            except OSError as e:
+                logger.warning(f"start pandoc server failed: {str(e)}")
+
+            logger.warning("pandoc server unavailable, fall back to subprocess")
+            self._failed = True
+            self.close()
+            return False
+
+    def render(self, source: Path, output: Path, token=None):
+        if not self._start():
+            return super().render(source, output, token)
+
+        request = urllib.request.Request(
+            f'http://127.0.0.1:{self._port}/'
+            , data=json.dumps({
+                'text': source.read_text(encoding='utf-8'),
+                'from': 'gfm',
+                'to': 'html5',
+                'standalone': True,
+                'template': self._template,
+            }).encode('utf-8')
+            , headers={
+                'Content-Type': 'application/json',
+                'Accept': 'application/json',
+            })
+
+        try:
+            with urllib.request.urlopen(
+                request, timeout=self.REQUEST_TIMEOUT) as response:
+                result = json.load(response)
+        except (OSError, ValueError) as e:
+            logger.warning(f"pandoc server render {source} failed: {str(e)}")
+            with self._lock:
+                self._failed = True
+                self.close()
+            return super().render(source, output, token)
+
+        if token and token.cancelled:
+            return False
+        temp = temp_file(output)
+        temp.write_text(result['output'], encoding='utf-8')
+        return replace_file(temp, output, True)
+
+    def close(self):
+        process, self._process = self._process, None
+        if process and process.poll() is None:
+            process.terminate()
+            try:
+                process.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+class MarkdownRenderer(IncrementalRenderer):
+    """进程内的gfm渲染, 省去进程启动, 用于实时预览"""
+    # 纯python渲染受GIL限制, 多线程不会更快, 只会与gui线程争抢
+    MAX_JOBS = 2
+
+    def __init__(self):
+        assert MarkdownIt, "markdown-it-py or its plugins are not installed"
+        # 与pandoc的gfm一致: 自动链接, 任务列表, 标题id
+        self._markdown = (
+            MarkdownIt('gfm-like', {'html': True})
+            .use(tasklists_plugin)
+            .use(anchors_plugin, max_level=6)
+        )
+        self._template = template_path().read_text(encoding='utf-8')
+
+    def version(self):
+        return f'markdown-it-py {markdown_it.__version__}'
+
+    def render(self, source: Path, output: Path, token=None):
+        self.write_page(self.render_fragment(
+            source.read_text(encoding='utf-8')), output)
+        return True
+
+    def render_fragment(self, text: str):
+        return self._markdown.render(text)
+
+    def write_page(self, body: str, output: Path):
+        temp = temp_file(output)
+        temp.write_text(fill_template(self._template, {
+            'title': '',
+            'body': body,
+        }), encoding='utf-8')
+        replace_file(temp, output, True)
+
+@cache
+def default_store():
+    return BlobStore(user_data_path() / 'miscellaneous' / '.blobs')
+
+@cache
+def default_renderer() -> Renderer:
+    if MarkdownIt:
+        return MarkdownRenderer()
+    return PandocServerRenderer()
+
 class Note(QObject):
-    modified = Signal(QUrl)
+    # 页面地址, 以及可增量更新页面时的补丁
+    modified = Signal(QUrl, object)
     name_changed = Signal(str)
-    def __init__(self, name='Untitled', id=''):
+    def __init__(self, name='Untitled', id='', renderer: Renderer | None = None,
+                 store: BlobStore | None = None, 
+                 search_index: SearchIndex | None = None,
+                 entry: dict | None = None):
         super().__init__()
 
         self._name = name
         self._id = id if id else str(uuid4())
+        self._renderer = renderer if renderer else default_renderer()
+        self._store = store if store else default_store()
+        self._search_index = search_index
+
+        # 页面中各块的html, 用于增量渲染
+        self._blocks: dict[str, str] = {}
+        # 已镜像到html目录的资源及其笔记目录中的状态
+        self._mirrored: dict[str, tuple] | None = None
+        # 构建线程与gui线程(add_resource)都会更新镜像
+        self._mirror_lock = threading.RLock()
+
+        # 从索引恢复, 不访问文件系统
+        if entry:
+            self._id = entry['id']
+            self._name = entry['name']
+            self._file_state = tuple(entry['state'])
+            self._file_hash = entry['hash']
+            self._built = entry['built']
+            return
 
         # create the note folder
         if not os.path.exists(self.note_folder):
@@ -53,7 +461,10 @@ class Note(QObject):
         # create output file
         self.output_file.touch(exist_ok=True)
 
+        self._file_state = get_file_state(self.path)
         self._file_hash = get_file_hash(self.path)
+        # 最近一次成功构建时的输入
+        self._built: dict | None = None
 
     @property
     def id(self):
@@ -67,6 +478,33 @@ class Note(QObject):
     def name(self, value):
         self._name = value
 
+    @property
+    def file_hash(self):
+        return self._file_hash
+
+    @property
+    def file_state(self):
+        return self._file_state
+
+    @property
+    def built(self):
+        """The build state of the current html file."""
+        return self._built
+    @built.setter
+    def built(self, value: dict | None):
+        self._built = value
+
+    def build_state(self, hash: str):
+        return {
+            'hash': hash,
+            'template': get_template_hash(),
+            'renderer': self._renderer.version(),
+        }
+
+    def is_built(self):
+        """Whether the html was built from the current markdown."""
+        return self._built == self.build_state(self._file_hash)
+
     @property
     def path(self) -> Path:
         """The path property."""
@@ -90,70 +528,126 @@ class Note(QObject):
     def serialize(self):
         return {
             'name': self._name,
-            'id': self._id
+            'id': self._id,
+            'state': list(self._file_state),
+            'hash': self._file_hash,
+            'built': self._built,
         }
 
     def add_resource(self, file_path: str):
         file_name = Path(file_path).name
 
-        shutil.copy(file_path, self.note_folder / file_name)
-        shutil.copy(file_path, self.html_folder / file_name)
+        with self._mirror_lock:
+            blob = self._store.add(self._id, file_name, file_path)
+            # 笔记目录中的资源可能被编辑, 不能与仓库共享数据
+            reflink_or_copy(blob, self.note_folder / file_name)
+            self._mirror_resource(file_name, blob)
 
-    def check_file_status(self):
-        hash = get_file_hash(self.path)
-        if hash != self._file_hash:
-            self.build(hash)
+    def update_file_hash(self):
+        """Rehash the markdown file, returns whether it has changed.
 
-    def build(self, hash = None):
-        if hash is not None:
-            self._file_hash = hash
+        The file is only read when its mtime, size or inode changed.
+        """
+        state = get_file_state(self.path)
+        if state == self._file_state:
+            return False
+        self._file_state = state
 
+        hash = get_file_hash(self.path)
+        if hash == self._file_hash:
+            return False
+        self._file_hash = hash
+        return True
+
+    def render(self, hash: str, token: CancelToken | None = None):
+        """Generate the html, safe to call off the gui thread.
+
+        Returns the build state (None on failure), the title, the rendered
+        blocks and the patch to the previous page (None if not incremental).
+        Returns None when cancelled through the token.
+        """
+        text = self.path.read_text(encoding='utf-8')
+
+        blocks = None
+        if isinstance(self._renderer, IncrementalRenderer):
+            blocks = split_blocks(text)
+
+        if blocks is None:
+            succeeded = self._renderer.render(
+                self.path, self.output_file, token)
+            rendered = {}
+            patch = None
         else:
-            self._file_hash = get_file_hash(self.path)
+            rendered, patch = self._render_blocks(blocks, token)
+            succeeded = True
 
-        pandoc = Path.cwd() / 'external' / 'pandoc.exe'
-        html = Path.cwd() / 'style' / 'github.html'
-
-        # markdown to html
-        subprocess.run([
-            pandoc, 
-            '-s', 
-            str(self.path), 
-            '-o', 
-            self.output_file, 
-            f'--template={html}',
-            '--from=gfm',
-        ], creationflags=subprocess.CREATE_NO_WINDOW)
+        if token and token.cancelled:
+            return None
 
         self._check_and_copy_resources()
 
-        self.modified.emit(self.url)
+        built = self.build_state(hash) if succeeded else None
+
+        if self._search_index:
+            self._search_index.update(self._id, hash, text)
+
+        return built, get_file_title(self.path), rendered, patch
+
+    def _render_blocks(self, blocks: list[str], token: CancelToken | None):
+        # 只渲染变动的块
+        renderer = self._renderer
+        assert isinstance(renderer, IncrementalRenderer)
+        keys = block_keys(blocks)
+        rendered = {}
+        for key, block in zip(keys, blocks):
+            if token and token.cancelled:
+                return {}, None
+            html = self._blocks.get(key)
+            rendered[key] = (html if html is not None 
+                else renderer.render_fragment(block))
+
+        renderer.write_page(''.join(
+            f'<div class="md-block" data-key="{key}">{rendered[key]}</div>\n'
+            for key in keys), self.output_file)
+
+        patch = {
+            'keys': keys,
+            'html': {k: v for k, v in rendered.items() if k not in self._blocks},
+        }
+
+        return rendered, patch
+
+    def finish_build(self, built: dict | None, name: str, 
+                     blocks: dict[str, str], patch: dict | None):
+        self._built = built
+        self._blocks = blocks
+
+        self.modified.emit(self.url, patch)
 
-        name = get_file_title(self.path)
         if name != self._name:
             self._name = name
             self.name_changed.emit(name)
 
-    def export_to_html(self, path):
-        pandoc = Path.cwd() / 'external' / 'pandoc.exe'
-        html = Path.cwd() / 'style' / 'github.html'
-        # markdown to html
-        subprocess.run([
-            pandoc, 
-            str(self.path), 
-            '-o', 
-            path,
-            f'--template={html}',
-            '--from=gfm',
-            '--embed-resources',
-            '--standalone', 
-        ], cwd=self.note_folder, creationflags=subprocess.CREATE_NO_WINDOW)
-
-    def export_to_word(self, path):
-        pandoc = Path.cwd() / 'external' / 'pandoc.exe'
+    def export_command(self, path, format: str):
+        """The pandoc command line exporting the note, run it in note_folder."""
+        pandoc = pandoc_path()
+        if format == 'html':
+            # markdown to html
+            return [
+                pandoc, 
+                str(self.path), 
+                '-o', 
+                path,
+                f'--template={template_path()}',
+                '--from=gfm',
+                '--embed-resources',
+                '--standalone', 
+            ]
+
+        assert format == 'docx', f"unknown export format: {format}"
         docx = Path.cwd() / 'style' / 'reference.docx'
-        # markdown to html
-        subprocess.run([
+        # markdown to docx
+        return [
             pandoc, 
             str(self.path), 
             '-o', 
@@ -161,14 +655,57 @@ class Note(QObject):
             f'--reference-doc={docx}',
             '--from=gfm',
             '--standalone', 
-        ], cwd=self.note_folder, creationflags=subprocess.CREATE_NO_WINDOW)
+        ]
+
+    def _mirror_resource(self, name: str, blob: Path):
+        if self._mirrored is None:
+            self._load_mirrored()
+        assert self._mirrored is not None
+
+        link_or_copy(blob, self.html_folder / name)
+        self._mirrored[name] = get_file_state(self.note_folder / name)
+
+    def _load_mirrored(self):
+        # 首次构建时从仓库引用恢复已镜像的资源
+        self._mirrored = {}
+        for name, digest in self._store.refs(self._id).items():
+            blob = self._store.path(digest)
+            try:
+                state = get_file_state(self.note_folder / name)
+                dst = os.stat(self.html_folder / name)
+                size = os.stat(blob).st_size
+            except OSError:
+                continue
+            if (os.path.samefile(blob, self.html_folder / name) or
+                    (dst.st_size == size == state[1] and dst.st_mtime_ns >= state[0])):
+                self._mirrored[name] = state
 
     def _check_and_copy_resources(self):
-        note_resources = [x.name for x in self.note_folder.iterdir()]
-        html_resources = [x.name for x in self.html_folder.iterdir()]
-        to_move_resources = [x for x in note_resources if x not in html_resources]
-        for x in to_move_resources:
-            shutil.copy(self.note_folder / x, self.html_folder / x)
+        with self._mirror_lock:
+            self._update_mirror()
+
+    def _update_mirror(self):
+        if self._mirrored is None:
+            self._load_mirrored()
+        assert self._mirrored is not None
+
+        # 只处理新增或变动的资源
+        names = set()
+        for entry in os.scandir(self.note_folder):
+            if entry.name == self.path.name or not entry.is_file():
+                continue
+            names.add(entry.name)
+            stat = entry.stat()
+            state = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+            if self._mirrored.get(entry.name) != state:
+                blob = self._store.ingest(self._id, entry.name, entry.path)
+                self._mirror_resource(entry.name, blob)
+
+        # 已删除的资源
+        for name in self._mirrored.keys() - names:
+            del self._mirrored[name]
+            self._store.release(self._id, name)
+            (self.html_folder / name).unlink(missing_ok=True)
 
     @property
     def html_folder(self):
@@ -179,12 +716,288 @@ class Note(QObject):
         return user_data_path() / 'miscellaneous' / '.notes' / self._id
 
     def clear(self):
-        shutil.rmtree(self.html_folder)
-        shutil.rmtree(self.note_folder)
+        self._store.release_note(self._id)
+        shutil.rmtree(self.html_folder, ignore_errors=True)
+        shutil.rmtree(self.note_folder, ignore_errors=True)
+
 
+class BuildTask(QRunnable):
+    def __init__(self, scheduler: 'BuildScheduler', note: Note, hash: str,
+                 priority: int, version: int):
+        super().__init__()
+        self.setAutoDelete(False)
+
+        self.scheduler = scheduler
+        self.note = note
+        self.hash = hash
+        self.priority = priority
+        # 请求构建时笔记内容的版本
+        self.version = version
+        self.token = CancelToken()
+        self.started = False
+
+    def run(self):
+        self.started = True
+        try:
+            result = self.note.render(self.hash, self.token)
+        except Exception as e:
+            logger.warning(f"build {self.note.id} failed: {str(e)}")
+            result = None
+        self.scheduler.task_finished.emit(self, result)
+
+class BuildScheduler(QObject):
+    """在线程池中并发构建笔记, 构建结果回到gui线程发出信号
+
+    同一笔记只保留最新的构建: 排队的任务合并, 运行中的任务被取消,
+    结果按版本号应用, 页面只会前进不会回退.
+    """
+    HIGH_PRIORITY = 1
+    NORMAL_PRIORITY = 0
+
+    # 编辑器保存时往往连续写入多次(或先删除再重命名), 等待事件平息后再构建
+    DEBOUNCE_INTERVAL = 150
+    # 持续保存时最长的等待, 保证预览仍能刷新
+    MAX_DELAY = 1000
+
+    task_finished = Signal(object, object)
+
+    def __init__(self, parent=None, max_jobs: int | None = None):
+        super().__init__(parent)
+
+        self._pool = QThreadPool(self)
+        self._pool.setMaxThreadCount(max_jobs or os.cpu_count() or 1)
+
+        # 排队或正在运行的任务
+        self._tasks: dict[str, BuildTask] = {}
+        # 运行期间笔记再次变动, 结束后需重新构建
+        self._pending: dict[str, tuple[Note, int]] = {}
+        # 等待变动平息的笔记, id -> (笔记, 优先级, 首次请求时间, 最近请求时间)
+        self._delayed: dict[str, tuple[Note, int, float, float]] = {}
+
+        # 每个笔记最新请求的版本, 以及页面上已应用的版本
+        self._versions: dict[str, int] = {}
+        self._applied: dict[str, int] = {}
+
+        self._stats = {
+            'requested': 0,
+            'built': 0,
+            'failed': 0,
+            # 合并到已排队或等待中的请求
+            'coalesced': 0,
+            # 被新版本中止的运行
+            'cancelled': 0,
+            # 结果比页面上的版本旧
+            'discarded': 0,
+        }
+
+        self._timer = QTimer(self)
+        self._timer.setSingleShot(True)
+        self._timer.timeout.connect(self._on_timeout)
+
+        self.task_finished.connect(self._on_task_finish)
+
+    def schedule(self, note: Note, priority=NORMAL_PRIORITY, debounce=False):
+        """Build the note, superseding any build of it not yet applied.
+
+        With debounce the build starts once requests for the note stop
+        arriving for DEBOUNCE_INTERVAL, or after MAX_DELAY at most.
+        """
+        self._stats['requested'] += 1
+        self._versions[note.id] = self._versions.get(note.id, 0) + 1
+
+        if debounce:
+            now = time.monotonic()
+            delayed = self._delayed.get(note.id)
+            if delayed:
+                self._stats['coalesced'] += 1
+                priority = max(priority, delayed[1])
+            first = delayed[2] if delayed else now
+            self._delayed[note.id] = (note, priority, first, now)
+            self._start_timer()
+            return
+
+        delayed = self._delayed.pop(note.id, None)
+        if delayed:
+            self._stats['coalesced'] += 1
+            priority = max(priority, delayed[1])
+        self._start(note, priority)
+
+    def prioritize(self, note: Note):
+        task = self._tasks.get(note.id)
+        if task and self._pool.tryTake(task):
+            task.priority = self.HIGH_PRIORITY
+            self._pool.start(task, task.priority)
+
+    def cancel(self, note: Note):
+        self._pending.pop(note.id, None)
+        self._delayed.pop(note.id, None)
+        self._versions.pop(note.id, None)
+        self._applied.pop(note.id, None)
+        task = self._tasks.pop(note.id, None)
+        if task and not self._pool.tryTake(task):
+            task.token.cancel()
+
+    def is_scheduled(self, note: Note):
+        return (note.id in self._tasks or note.id in self._delayed
+            or note.id in self._pending)
+
+    def stats(self):
+        """Counters for tuning, queue depths and dropped builds."""
+        running = sum(x.started for x in self._tasks.values())
+        stats = dict(self._stats)
+        stats.update({
+            'queued': len(self._tasks) - running,
+            'running': running,
+            'delayed': len(self._delayed),
+            'pending': len(self._pending),
+            'dropped': (self._stats['coalesced'] + self._stats['cancelled']
+                + self._stats['discarded']),
+        })
+        return stats
+
+    def close(self):
+        self._timer.stop()
+        self._delayed.clear()
+        self._pending.clear()
+        self._pool.clear()
+        for task in self._tasks.values():
+            task.token.cancel()
+        self._pool.waitForDone()
+
+    def _start(self, note: Note, priority: int):
+        version = self._versions.get(note.id, 0)
+        task = self._tasks.get(note.id)
+        if task:
+            if self._pool.tryTake(task):
+                self._stats['coalesced'] += 1
+                task.hash = note.file_hash
+                task.version = version
+                task.priority = max(priority, task.priority)
+                self._pool.start(task, task.priority)
+            else:
+                # 同一笔记的构建依次进行, 中止当前运行, 结束后再构建最新版本
+                if note.id in self._pending:
+                    self._stats['coalesced'] += 1
+                    priority = max(priority, self._pending[note.id][1])
+                self._pending[note.id] = (note, priority)
+                task.token.cancel()
+            return
+
+        task = BuildTask(self, note, note.file_hash, priority, version)
+        self._tasks[note.id] = task
+        self._pool.start(task, priority)
+
+    def _start_timer(self):
+        if not self._delayed:
+            self._timer.stop()
+            return
+        deadline = min(self._deadline(x) for x in self._delayed.values())
+        self._timer.start(max(0, int((deadline - time.monotonic()) * 1000)))
+
+    def _deadline(self, delayed: tuple[Note, int, float, float]):
+        _, _, first, last = delayed
+        return min(last + self.DEBOUNCE_INTERVAL / 1000,
+                   first + self.MAX_DELAY / 1000)
+
+    @Slot()
+    def _on_timeout(self):
+        now = time.monotonic()
+        for id, delayed in list(self._delayed.items()):
+            if self._deadline(delayed) <= now:
+                del self._delayed[id]
+                self._start(delayed[0], delayed[1])
+        self._start_timer()
+
+    @Slot() #type: ignore
+    def _on_task_finish(self, task: BuildTask, result):
+        note = task.note
+        if self._tasks.get(note.id) is not task:
+            # 已取消
+            return
+        del self._tasks[note.id]
+
+        if task.token.cancelled:
+            self._stats['cancelled'] += 1
+        elif not result:
+            self._stats['failed'] += 1
+        elif task.version <= self._applied.get(note.id, 0):
+            self._stats['discarded'] += 1
+        else:
+            self._applied[note.id] = task.version
+            self._stats['built'] += 1
+            note.finish_build(*result)
+
+        if note.id in self._pending:
+            note, priority = self._pending.pop(note.id)
+            self._start(note, priority)
+
+class ReconcileTask(QRunnable):
+    """后台比对索引与文件系统"""
+    def __init__(self, book: 'Book', notes: dict[str, tuple]):
+        super().__init__()
+
+        self.book = book
+        # id -> 索引中的文件状态
+        self.notes = notes
+
+    def run(self):
+        result = {'added': [], 'removed': [], 'changed': [], 'unbuilt': []}
+        seen = set()
+        folder = self.book.user_path / '.notes'
+        html_folder = self.book.user_path / '.htmls'
+        try:
+            entries = list(os.scandir(folder))
+        except OSError as e:
+            logger.warning(f"reconcile book failed: {str(e)}")
+            return
+
+        for entry in entries:
+            id = entry.name
+            state = self.notes.get(id)
+            if state is None:
+                result['added'].append(id)
+                continue
+            seen.add(id)
+            try:
+                if get_file_state(Path(entry.path) / (id + '.md')) != state:
+                    result['changed'].append(id)
+            except OSError:
+                # 目录还在, 文件可能正被编辑器替换, 不算删除
+                continue
+            if not os.path.exists(html_folder / id / (id + '.html')):
+                result['unbuilt'].append(id)
+
+        # 只有笔记目录已不存在的才算删除
+        result['removed'].extend(self.notes.keys() - seen)
+        self.book.reconciled.emit(result)
+
+class IndexTask(QRunnable):
+    """后台载入全文索引, 并补齐缺失或过时的笔记"""
+    def __init__(self, book: 'Book', notes: list[tuple[str, str, Path]]):
+        super().__init__()
+
+        self.book = book
+        self.notes = notes
+
+    def run(self):
+        index = self.book.search_index
+        for id, hash, path in self.notes:
+            if index.hash(id) == hash:
+                continue
+            try:
+                text = path.read_text(encoding='utf-8')
+            except OSError:
+                continue
+            index.update(id, hash, text)
+        self.book.search_index_changed.emit()
 
 class Book(QObject):
-    current_note_modified = Signal(QUrl)
+    # 无法监听文件时退回轮询
+    POLL_INTERVAL = 1000
+    # 文件被替换的过程中暂时不存在, 短间隔重试
+    RETRY_INTERVAL = 100
+
+    current_note_modified = Signal(QUrl, object)
     current_note_name_change = Signal(str)
 
     new_note = Signal(Note)
@@ -192,20 +1005,35 @@ class Book(QObject):
 
     note_removed = Signal(Note)
 
-    def __init__(self):
+    reconciled = Signal(object)
+    search_index_changed = Signal()
+
+    # 索引格式版本
+    VERSION = 2
+
+    def __init__(self, renderer: Renderer | None = None):
         super().__init__()
 
         self._notes: list[Note] = []
         self._current_note: Note | None = None
+        self._renderer = renderer if renderer else default_renderer()
 
         self._timer = QTimer(self)
+        self._watcher = QFileSystemWatcher(parent=self)
 
         if not os.path.exists(self.user_path):
             os.makedirs(self.user_path)
 
-        self._timer.timeout.connect(self._on_check_file_status)
+        # 与未指定仓库的笔记共用一个实例, 引用计数只有一份
+        self._store = default_store()
+        self._search_index = SearchIndex(self.user_path / 'search')
+        # 首次搜索时补齐索引中缺失或过时的笔记
+        self._search_index_checked = False
+        self._scheduler = BuildScheduler(self, self._renderer.MAX_JOBS)
 
-        self._timer.start(1000)
+        self._timer.timeout.connect(self._on_check_file_status)
+        self._watcher.fileChanged.connect(self._on_file_change)
+        self.reconciled.connect(self._on_reconcile)
 
         self.load()
 
@@ -217,14 +1045,57 @@ class Book(QObject):
 
     @Slot()
     def _on_check_file_status(self):
-        if self._current_note:
-            self._current_note.check_file_status()
+        note = self._current_note
+        if not note:
+            return
+
+        # 原子保存(写临时文件再重命名)会使监听失效, 需要重新添加;
+        # 文件暂时不存在时轮询, 直到重新出现
+        path = str(note.path)
+        if path not in self._watcher.files():
+            if not os.path.exists(path):
+                self._timer.start(self.RETRY_INTERVAL)
+                return
+            if self._watcher.addPath(path):
+                self._timer.stop()
+            elif (not self._timer.isActive() or
+                    self._timer.interval() != self.POLL_INTERVAL):
+                logger.warning(f"watch {path} failed, fall back to polling")
+                self._timer.start(self.POLL_INTERVAL)
+
+        try:
+            changed = note.update_file_hash()
+        except FileNotFoundError:
+            self._timer.start(self.RETRY_INTERVAL)
+            return
+        if changed:
+            self._scheduler.schedule(
+                note, BuildScheduler.HIGH_PRIORITY, debounce=True)
+
+    @Slot() #type: ignore
+    def _on_file_change(self, path: str):
+        self._on_check_file_status()
+
+    def _watch(self, note: Note | None):
+        files = self._watcher.files()
+        if files:
+            self._watcher.removePaths(files)
+
+        if note is None:
+            self._timer.stop()
+            return
+
+        if self._watcher.addPath(str(note.path)):
+            self._timer.stop()
+        else:
+            logger.warning(f"watch {note.path} failed, fall back to polling")
+            self._timer.start(self.POLL_INTERVAL)
 
     @Slot()
-    def _on_note_modify(self, url: str):
+    def _on_note_modify(self, url: QUrl, patch: dict | None):
         if self._current_note:
             if url == self._current_note.url:
-                self.current_note_modified.emit(url)
+                self.current_note_modified.emit(url, patch)
 
     @Slot() #type: ignore
     def _on_note_name_change(self, name: str) -> None:
@@ -233,15 +1104,25 @@ class Book(QObject):
                 self.current_note_name_change.emit(name)
 
     def create_note(self):
-        self._add_note(Note())
+        self._add_note(self._create_note())
+
+    def _create_note(self, **kwargs):
+        return Note(renderer=self._renderer, store=self._store, 
+                    search_index=self._search_index, **kwargs)
 
     def remove_note(self, note: Note):
+        self._drop_note(note)
+        note.clear()
+
+    def _drop_note(self, note: Note):
+        # 只从书中移除, 不删除文件
         note.modified.disconnect(self._on_note_modify)
         note.name_changed.disconnect(self._on_note_name_change)
 
         self._notes.remove(note)
 
-        note.clear()
+        self._scheduler.cancel(note)
+        self._search_index.remove(note.id)
 
         self.note_removed.emit(note)
 
@@ -249,21 +1130,32 @@ class Book(QObject):
             self.current_note = self._notes[-1] if self._notes else None
 
     def _add_note(self, note: Note):
-        self._notes.append(note)
+        self._append_note(note)
 
         self._current_note = note;
+        self._watch(note)
+
+        self.new_note.emit(note)
+
+        return note
+
+    def _append_note(self, note: Note):
+        # 不监听文件, 也不发出new_note, 用于载入
+        self._notes.append(note)
 
         note.modified.connect(self._on_note_modify)
         note.name_changed.connect(self._on_note_name_change)
 
-        self.new_note.emit(note)
-
         return note
 
     def add_resource(self, file_path: str):
         if self._current_note:
             self._current_note.add_resource(file_path)
 
+    @property
+    def search_index(self):
+        return self._search_index
+
     @property
     def user_path(self):
         return user_data_path() / 'miscellaneous'
@@ -272,21 +1164,112 @@ class Book(QObject):
         file_name = self.user_path / 'book'
         with open(file_name, 'wb') as file:
             file.write(msgpack.packb({
+                'version': self.VERSION,
                 'notes': [x.serialize() for x in self._notes]
             })) # type: ignore
 
+        self._store.save()
+        self._search_index.save()
+
     def load(self):
         folder = self.user_path / '.notes'
         if not folder.exists():
             folder.mkdir()
             return
 
-        for note_path in folder.iterdir():
-            note = self._add_note(Note(id=note_path.stem))
-            note.build()
+        entries = self._read_index()
+        if entries is None:
+            self._scan(folder)
+        else:
+            for entry in entries:
+                note = self._append_note(self._create_note(entry=entry))
+                if not note.is_built():
+                    self._scheduler.schedule(note)
+
+            # 索引可能已过时, 后台比对文件系统
+            QThreadPool.globalInstance().start(ReconcileTask(self,
+                {x.id: x.file_state for x in self._notes}))
 
         if self._notes:
             self._current_note = self._notes[0]
+            self._watch(self._current_note)
+            self._scheduler.prioritize(self._current_note)
+
+    def _read_index(self):
+        try:
+            with open(self.user_path / 'book', 'rb') as file:
+                data = msgpack.unpackb(file.read())
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.warning(f"load book index failed: {str(e)}")
+            return None
+
+        if data.get('version') != self.VERSION:
+            return None
+        return data['notes']
+
+    def _scan(self, folder: Path):
+        for note_path in folder.iterdir():
+            note = self._append_note(self._create_note(id=note_path.stem))
+            note.name = get_file_title(note.path)
+            self._scheduler.schedule(note)
+
+    @Slot() #type: ignore
+    def _on_reconcile(self, result: dict):
+        notes = {x.id: x for x in self._notes}
+
+        # 笔记目录已被外部删除, 不再需要清理文件
+        for id in result['removed']:
+            if id in notes:
+                self._drop_note(notes[id])
+
+        for id in result['changed']:
+            note = notes.get(id)
+            if note and note.update_file_hash() and not note.is_built():
+                self._scheduler.schedule(note)
+
+        for id in result['unbuilt']:
+            note = notes.get(id)
+            if note:
+                note.built = None
+                self._scheduler.schedule(note)
+
+        current = self._current_note
+        for id in result['added']:
+            if id not in notes:
+                # 先设置标题, 列表按new_note时的名称创建项
+                note = self._create_note(id=id)
+                note.name = get_file_title(note.path)
+                self._scheduler.schedule(self._add_note(note))
+        if current and self._current_note is not current:
+            self.current_note = current
+
+    def prepare_search(self):
+        if self._search_index_checked:
+            return
+        self._search_index_checked = True
+        QThreadPool.globalInstance().start(IndexTask(self,
+            [(x.id, x.file_hash, x.path) for x in self._notes]))
+
+    def search(self, query: str, limit: int | None = None) -> list[Note]:
+        """Notes matching the query while it is being typed, best first.
+
+        Nothing matches until the index is loaded in the background,
+        search_index_changed is emitted then.
+        """
+        self.prepare_search()
+        notes = {x.id: x for x in self._notes}
+        return [notes[id] for id, _ in self._search_index.search(
+            query, limit, prefix_last=True, wait=False) if id in notes]
+
+    def build_stats(self):
+        return self._scheduler.stats()
+
+    def close(self):
+        QThreadPool.globalInstance().waitForDone()
+        self._scheduler.close()
+        self._renderer.close()
 
     @property
     def current_note(self):
@@ -297,4 +1280,7 @@ class Book(QObject):
         if self._current_note == value:
             return
         self._current_note = value
+        self._watch(value)
+        if value:
+            self._scheduler.prioritize(value)
         self.current_note_changed.emit(value)
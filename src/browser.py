@@ -1,6 +1,8 @@
-from PySide6.QtCore import Signal, Slot
+import json
+from PySide6.QtCore import QFile, QIODevice, QObject, QUrl, Signal, Slot
 from PySide6.QtGui import QAction, QDesktopServices, QDragEnterEvent, QDropEvent, QIcon
-from PySide6.QtWebEngineCore import QWebEngineSettings
+from PySide6.QtWebChannel import QWebChannel
+from PySide6.QtWebEngineCore import QWebEngineScript, QWebEngineSettings
 from PySide6.QtWebEngineWidgets import QWebEngineView
 from PySide6.QtWidgets import QMainWindow, QSizePolicy
 from loguru import logger
@@ -9,6 +11,98 @@ from book import Book
 from utils import append_class, place_holder
 from utils.resource import url 
 
+# 页面端: 按块的key复用已有节点, 只插入新块, 移除消失的块
+PREVIEW_SCRIPT = """
+new QWebChannel(qt.webChannelTransport, function (channel) {
+    const bridge = channel.objects.preview;
+
+    bridge.patch_ready.connect(function (data) {
+        const patch = JSON.parse(data);
+        const root = document.querySelector('article.markdown-body');
+        if (!root) {
+            bridge.request_reload();
+            return;
+        }
+
+        const existing = new Map();
+        for (const node of root.querySelectorAll(':scope > .md-block')) {
+            existing.set(node.dataset.key, node);
+        }
+
+        const nodes = [];
+        for (const key of patch.keys) {
+            let node = existing.get(key);
+            if (!node) {
+                const html = patch.html[key];
+                if (html === undefined) {
+                    bridge.request_reload();
+                    return;
+                }
+                node = document.createElement('div');
+                node.className = 'md-block';
+                node.dataset.key = key;
+                node.innerHTML = html;
+            }
+            nodes.push(node);
+        }
+
+        let child = root.firstChild;
+        for (const node of nodes) {
+            if (child === node) {
+                child = child.nextSibling;
+            } else {
+                root.insertBefore(node, child);
+            }
+        }
+        while (child) {
+            const next = child.nextSibling;
+            root.removeChild(child);
+            child = next;
+        }
+    });
+
+    bridge.connect_page();
+});
+"""
+
+def preview_script():
+    file = QFile(':/qtwebchannel/qwebchannel.js')
+    file.open(QIODevice.OpenModeFlag.ReadOnly)
+    source = bytes(file.readAll().data()).decode('utf-8')
+    file.close()
+
+    script = QWebEngineScript()
+    script.setName('preview')
+    script.setSourceCode(source + PREVIEW_SCRIPT)
+    script.setInjectionPoint(QWebEngineScript.InjectionPoint.DocumentReady)
+    script.setWorldId(QWebEngineScript.ScriptWorldId.MainWorld)
+    script.setRunsOnSubFrames(False)
+    return script
+
+class PreviewBridge(QObject):
+    """通过QWebChannel把增量补丁发送给页面"""
+    patch_ready = Signal(str)
+    reload_requested = Signal()
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self._ready = False
+
+    @property
+    def ready(self):
+        return self._ready
+    @ready.setter
+    def ready(self, value: bool):
+        self._ready = value
+
+    @Slot()
+    def connect_page(self):
+        self._ready = True
+
+    @Slot()
+    def request_reload(self):
+        self.reload_requested.emit()
+
 class DragWebEngineView(QWebEngineView):
     def __init__(self, parent, book):
         super().__init__(parent)
@@ -37,6 +131,14 @@ class Browser(QMainWindow):
 
         self._web_engine_view = DragWebEngineView(self, book)
 
+        self._bridge = PreviewBridge(self)
+        self._channel = QWebChannel(self)
+        self._channel.registerObject('preview', self._bridge)
+
+        page = self._web_engine_view.page()
+        page.setWebChannel(self._channel)
+        page.scripts().insert(preview_script())
+
         self._tool_bar = self.addToolBar('')
 
         self._tool_bar.setMovable(False)
@@ -58,6 +160,9 @@ class Browser(QMainWindow):
         self._side_resource_action.triggered.connect(self._on_side_resource_trigger)
         self._open_in_browser_action.triggered.connect(self._on_open_in_browser)
 
+        self._web_engine_view.loadStarted.connect(self._on_load_start)
+        self._bridge.reload_requested.connect(self.reload)
+
         self.setCentralWidget(self._web_engine_view)
 
         self._side_note_action.setVisible(False)
@@ -80,9 +185,14 @@ class Browser(QMainWindow):
         if note:
             QDesktopServices.openUrl(note.url)
 
+    @Slot()
     def reload(self):
         self._web_engine_view.reload()
 
+    @Slot()
+    def _on_load_start(self):
+        self._bridge.ready = False
+
     @Slot()
     def _on_side_note_trigger(self):
         self.side_note_triggered.emit()
@@ -96,6 +206,16 @@ class Browser(QMainWindow):
     def setUrl(self, url):
         self._web_engine_view.setUrl(url)
 
+    def patch(self, url: QUrl, patch: dict):
+        """Patch the changed blocks into the live page.
+
+        Returns False if the page is not ready, the caller should reload it.
+        """
+        if not self._bridge.ready or self._web_engine_view.url() != url:
+            return False
+        self._bridge.patch_ready.emit(json.dumps(patch))
+        return True
+
     def show_side_note_action(self):
         self._side_note_action.setVisible(True)
 
@@ -0,0 +1,208 @@
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+import threading
+import zipfile
+from pathlib import Path
+from PySide6.QtCore import QObject, QRunnable, QThreadPool, QTimer, Signal, Slot
+from loguru import logger
+
+from book import Note
+
+def export_name(note: Note, format: str, used: set[str]):
+    """A file name for the note unique within an export."""
+    name = re.sub(r'[\\/:*?"<>|\s]+', '_', note.name).strip('_') or note.id
+    candidate = f'{name}.{format}'
+    i = 1
+    while candidate.lower() in used:
+        i += 1
+        candidate = f'{name}_{i}.{format}'
+    used.add(candidate.lower())
+    return candidate
+
+class ExportJob(QRunnable):
+    def __init__(self, batch: 'ExportBatch', command: list, cwd: Path):
+        super().__init__()
+        self.setAutoDelete(False)
+
+        self.batch = batch
+        self.command = command
+        self.cwd = cwd
+
+    def run(self):
+        succeeded = False
+        try:
+            process = self.batch.start_process(self.command, self.cwd)
+            if process:
+                succeeded = process.wait() == 0
+                self.batch.end_process(process)
+        except OSError as e:
+            logger.warning(f"export failed: {str(e)}")
+        self.batch.job_finished.emit(self, succeeded)
+
+class ArchiveJob(QRunnable):
+    def __init__(self, batch: 'ExportBatch', folder: Path, archive: Path):
+        super().__init__()
+
+        self.batch = batch
+        self.folder = folder
+        self.archive = archive
+
+    def run(self):
+        succeeded = False
+        try:
+            with zipfile.ZipFile(self.archive, 'w', zipfile.ZIP_DEFLATED) as file:
+                for path in sorted(self.folder.iterdir()):
+                    if self.batch.cancelled:
+                        break
+                    file.write(path, path.name)
+            succeeded = not self.batch.cancelled
+        except OSError as e:
+            logger.warning(f"archive {self.archive} failed: {str(e)}")
+        finally:
+            shutil.rmtree(self.folder, ignore_errors=True)
+        if not succeeded:
+            Path(self.archive).unlink(missing_ok=True)
+        self.batch.archived.emit(succeeded)
+
+class ExportBatch(QObject):
+    """一次导出, 包含一个或多个pandoc任务, 可取消"""
+    # 已完成的任务数, 任务总数
+    progress = Signal(int, int)
+    # 是否全部成功
+    finished = Signal(bool)
+
+    job_finished = Signal(object, bool)
+    archived = Signal(bool)
+
+    def __init__(self, pool: QThreadPool, archive: Path | None = None,
+                 folder: Path | None = None):
+        super().__init__()
+
+        self._pool = pool
+        self._archive = archive
+        self._folder = folder
+        self._jobs: list[ExportJob] = []
+        self._done = 0
+        self._failed = 0
+        self._cancelled = False
+        self._lock = threading.Lock()
+        self._processes: set[subprocess.Popen] = set()
+
+        self.job_finished.connect(self._on_job_finish)
+        self.archived.connect(self._on_archive)
+
+    @property
+    def cancelled(self):
+        return self._cancelled
+
+    @property
+    def total(self):
+        return len(self._jobs)
+
+    def add(self, command: list, cwd: Path):
+        self._jobs.append(ExportJob(self, command, cwd))
+
+    def start(self):
+        if not self._jobs:
+            QTimer.singleShot(0, self._finish)
+            return
+        for job in self._jobs:
+            self._pool.start(job)
+
+    def cancel(self):
+        with self._lock:
+            self._cancelled = True
+            processes = list(self._processes)
+        for job in self._jobs:
+            if self._pool.tryTake(job):
+                self.job_finished.emit(job, False)
+        for process in processes:
+            process.terminate()
+
+    def start_process(self, command: list, cwd: Path):
+        with self._lock:
+            if self._cancelled:
+                return None
+            process = subprocess.Popen(command, cwd=cwd,
+                creationflags=subprocess.CREATE_NO_WINDOW)
+            self._processes.add(process)
+            return process
+
+    def end_process(self, process: subprocess.Popen):
+        with self._lock:
+            self._processes.discard(process)
+
+    @Slot() #type: ignore
+    def _on_job_finish(self, job: ExportJob, succeeded: bool):
+        self._done += 1
+        if not succeeded:
+            self._failed += 1
+        self.progress.emit(self._done, self.total)
+
+        if self._done < self.total:
+            return
+
+        if self._archive and self._folder and not self._cancelled:
+            self._pool.start(ArchiveJob(self, self._folder, self._archive))
+        else:
+            if self._folder:
+                shutil.rmtree(self._folder, ignore_errors=True)
+            self._finish()
+
+    @Slot() #type: ignore
+    def _on_archive(self, succeeded: bool):
+        if not succeeded:
+            self._failed += 1
+        self._finish()
+
+    def _finish(self):
+        self.finished.emit(not self._cancelled and not self._failed)
+
+class Exporter(QObject):
+    """在后台线程中导出笔记, 限制同时运行的pandoc进程数"""
+    MAX_JOBS = max(1, (os.cpu_count() or 2) // 2)
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+
+        self._pool = QThreadPool(self)
+        self._pool.setMaxThreadCount(self.MAX_JOBS)
+        self._batches: set[ExportBatch] = set()
+
+    def export(self, note: Note, path, format: str):
+        """Export a note to html or docx."""
+        batch = ExportBatch(self._pool)
+        batch.add(note.export_command(path, format), note.note_folder)
+        return self._start(batch)
+
+    def export_book(self, notes: list[Note], path, format: str):
+        """Export all notes into a folder, or a zip archive if path ends with .zip."""
+        path = Path(path)
+        if path.suffix.lower() == '.zip':
+            folder = Path(tempfile.mkdtemp(prefix='export-'))
+            batch = ExportBatch(self._pool, path, folder)
+        else:
+            folder = path
+            folder.mkdir(parents=True, exist_ok=True)
+            batch = ExportBatch(self._pool)
+
+        used = set()
+        for note in notes:
+            output = folder / export_name(note, format, used)
+            batch.add(note.export_command(output, format), note.note_folder)
+        return self._start(batch)
+
+    def close(self):
+        for batch in list(self._batches):
+            batch.cancel()
+        self._pool.waitForDone()
+
+    def _start(self, batch: ExportBatch):
+        self._batches.add(batch)
+        batch.finished.connect(lambda _: self._batches.discard(batch))
+        # 结果经由事件循环送达, 调用方返回后再连接信号也不会错过
+        batch.start()
+        return batch
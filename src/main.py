@@ -36,6 +36,7 @@ if __name__ == "__main__":
 
     main_widget.show()
     app.exec()
+    book.close()
     book.save()
     nvim.close()
     proxy.close()
@@ -1,39 +1,73 @@
-from PySide6.QtGui import QAction, QContextMenuEvent, QCursor, QIcon, QPixmap
-from PySide6.QtCore import Signal, Slot
+from PySide6.QtGui import QAction, QCursor, QIcon
+from PySide6.QtCore import QCoreApplication, QPoint, QTimer, Signal, Slot
 from PySide6.QtWidgets import (
     QFileDialog,
-    QHBoxLayout,
-    QLabel,
+    QLineEdit,
     QMainWindow, 
     QMenu,
-    QToolButton,
+    QProgressDialog,
+    QWidget,
 )
 from loguru import logger
 from platformdirs import user_desktop_dir, user_desktop_path
 from book import Book, Note
-from utils import append_class, override, place_holder
-from utils.listview import Item, ListView
+from exporter import ExportBatch, Exporter
+from utils import append_class, place_holder
+from utils.listview import ListItem, ListView
 from utils.resource import url 
 
+def track_export(batch: ExportBatch, label: str, parent: QWidget):
+    """Show the progress of an export once it takes noticeable time."""
+    dialog = QProgressDialog(label, 'cancel', 0, batch.total, parent)
+    dialog.setMinimumDuration(500)
+    dialog.setValue(0)
+
+    def on_finish(succeeded):
+        if not succeeded and not batch.cancelled:
+            logger.warning(f"{label} failed")
+        # close会发出canceled, 断开后再关闭, 以免取消已结束的导出
+        dialog.canceled.disconnect(batch.cancel)
+        dialog.close()
+        dialog.deleteLater()
+
+    batch.progress.connect(lambda done, _: dialog.setValue(done))
+    batch.finished.connect(on_finish)
+    dialog.canceled.connect(batch.cancel)
+
 class NoteListView(QMainWindow):
+    # 输入停顿后再搜索, 连续输入时不逐字查询
+    SEARCH_DELAY = 150
+
     side_bar_triggered = Signal()
 
     def __init__(self, book: Book):
         super().__init__()
         self._book = book
 
-        self._note_list = ListView()
+        # 笔记很多时逐个创建控件太慢, 使用虚拟列表
+        self._note_list = ListView(
+            virtual=True, menu_icon=QIcon(url('more_horiz.svg')))
+        self._note_icon = QIcon(url('news.svg'))
+        self._exporter = Exporter(self)
+        # 弹出菜单所属的项
+        self._menu_item: NoteItem|None = None
 
         self._init_toolbar()
+        self._init_item_menu()
         self.setCentralWidget(self._note_list)
 
         book.new_note.connect(self._on_new_note)
         book.current_note_changed.connect(self._on_current_note_change)
+        book.note_removed.connect(self._on_note_remove)
+        book.search_index_changed.connect(self._on_search)
 
         self._note_list.item_changed.connect(self._on_item_change)
+        self._note_list.menu_requested.connect(self._on_item_menu_request)
 
         self._load()
 
+        QCoreApplication.instance().aboutToQuit.connect(self._exporter.close)
+
         append_class(self, 'bg-normal')
         self._note_list.set_table_style()
         self._note_list.setStyleSheet("""
@@ -65,6 +99,15 @@ class NoteListView(QMainWindow):
         self._new_note_action = QAction(QIcon(url('edit_square.svg')),
                                         'add new note', self)
 
+        self._export_book_action = QAction(QIcon(url('system_update_alt.svg')),
+                                           'export all notes', self)
+        self._export_menu = QMenu(self)
+        self._export_book_to_html_action = self._export_menu.addAction(
+            'export all notes to html')
+        self._export_book_to_word_action = self._export_menu.addAction(
+            'export all notes to word')
+        self._export_book_action.setMenu(self._export_menu)
+
         self._place_holder = place_holder()
 
         self._toolbar.setMovable(False)
@@ -72,55 +115,39 @@ class NoteListView(QMainWindow):
         self._toolbar.addAction(self._side_bar_action)
         self._toolbar.addWidget(self._place_holder)
         self._toolbar.addAction(self._search_action)
+        self._toolbar.addAction(self._export_book_action)
         self._toolbar.addAction(self._new_note_action)
 
         self._new_note_action.triggered.connect(lambda: self._on_create_note())
         self._side_bar_action.triggered.connect(self._on_side_bar_trigger)
-
-    @Slot()
-    def _on_side_bar_trigger(self):
-        self.hide()
-        self.side_bar_triggered.emit()
-
-    @Slot()
-    def _on_new_note(self, note: Note):
-        note_item = NoteItem(note)
-
-        self._note_list.add_item(note_item)
-        note_item.removed.connect(self._on_note_item_remove)
-
-        self._note_list.set_active(0)
-
-    def _load(self):
-        for note in self._book:
-            note_item = NoteItem(note)
-
-            self._note_list.add_item(note_item)
-            note_item.removed.connect(self._on_note_item_remove)
-
-        if self._book:
-            self._note_list.set_active(0)
-
-    @Slot()
-    def _on_note_item_remove(self, note_item):
-        self._book.remove_note(note_item.note)
-        self._note_list.delete_item(note_item)
-        logger.debug("remove note")
-
-    @Slot()
-    def _on_create_note(self):
-        self._book.create_note()
-
-class NoteItem(Item):
-    removed = Signal(Item)
-    def __init__(self, note: Note):
-        super().__init__()
-        self._note = note;
-
-        layout = QHBoxLayout(self)
-        name_label = QLabel(note.name)
-
-        self._more_menu = QMenu(self)
+        self._search_action.triggered.connect(self._on_search_trigger)
+        self._export_book_action.triggered.connect(
+            lambda: self._export_menu.exec(QCursor.pos()))
+        self._export_book_to_html_action.triggered.connect(
+            lambda: self._on_export_book_trigger('html'))
+        self._export_book_to_word_action.triggered.connect(
+            lambda: self._on_export_book_trigger('docx'))
+
+        self.addToolBarBreak()
+        self._search_bar = self.addToolBar('search')
+        self._search_edit = QLineEdit()
+
+        self._search_edit.setPlaceholderText('search notes')
+        self._search_edit.setClearButtonEnabled(True)
+        self._search_bar.setMovable(False)
+        self._search_bar.addWidget(self._search_edit)
+        self._search_bar.hide()
+
+        self._search_timer = QTimer(self)
+        self._search_timer.setSingleShot(True)
+        self._search_timer.setInterval(self.SEARCH_DELAY)
+
+        self._search_edit.textChanged.connect(self._search_timer.start)
+        self._search_timer.timeout.connect(self._on_search)
+        self._search_edit.returnPressed.connect(self._on_search_accept)
+
+    def _init_item_menu(self):
+        self._item_menu = QMenu(self)
         self._export_to_html_action = QAction(
             QIcon(url('system_update_alt.svg')), 
             'export to html', self)
@@ -129,73 +156,128 @@ class NoteItem(Item):
             QIcon(url('system_update_alt.svg')), 
             'export to word', self)
 
-
         self._remove_action = QAction(
             QIcon(url('do_not_disturb_on.svg')), 
             'delete the note', self)
 
-        self._more_button = QToolButton()
-        self._more_action = QAction(QIcon(url('more_horiz.svg')), '', self)
-        icon_label = QLabel()
-
-        self._more_menu.addAction(self._export_to_html_action)
-        self._more_menu.addAction(self._export_to_word_action)
-        self._more_menu.addAction(self._remove_action)
-
-        icon_label.setPixmap(QPixmap(url('news.svg')))
-
-        self._more_button.setDefaultAction(self._more_action)
-
-        layout.addWidget(icon_label)
-        layout.addWidget(name_label)
-        layout.addStretch()
-        layout.addWidget(self._more_button)
-
-        note.name_changed.connect(lambda name: name_label.setText(name))
-
-        self._more_button.clicked.connect(
-            lambda: self._more_menu.exec(QCursor.pos()))
+        self._item_menu.addAction(self._export_to_html_action)
+        self._item_menu.addAction(self._export_to_word_action)
+        self._item_menu.addAction(self._remove_action)
 
         self._remove_action.triggered.connect(self._on_remove_trigger)
         self._export_to_html_action.triggered.connect(self._on_export_to_html_trigger)
         self._export_to_word_action.triggered.connect(self._on_export_to_word_trigger)
 
-        self.active_changed.connect(lambda x: self._more_button.setVisible(x))
-
-        self.hovered.connect(self._on_hover)
-
-        self._more_button.setVisible(self.active)
-
-        # append_class(self, 'square')
-        self.setMaximumHeight(40)
-
-    @Slot()
-    def _on_hover(self, flag):
-        self._more_button.setVisible(flag)
-        if self.active:
-            self._more_button.setVisible(True)
+    @Slot() #type: ignore
+    def _on_item_menu_request(self, item, pos: QPoint):
+        self._menu_item = item
+        self._item_menu.exec(pos)
 
     @Slot()
     def _on_remove_trigger(self):
-        self.removed.emit(self)
+        if self._menu_item:
+            self._book.remove_note(self._menu_item.note)
+            logger.debug("remove note")
 
     @Slot()
     def _on_export_to_html_trigger(self):
+        if not self._menu_item:
+            return
         file_name, _ = QFileDialog.getSaveFileName(self, 'export to html', user_desktop_dir(), '*.html')
         if file_name:
-            self._note.export_to_html(file_name)
+            track_export(self._exporter.export(self._menu_item.note, file_name, 'html'),
+                         'export to html', self)
 
     @Slot()
     def _on_export_to_word_trigger(self):
+        if not self._menu_item:
+            return
         file_name, _ = QFileDialog.getSaveFileName(self, 'export to html', user_desktop_dir(), '*.docx')
         if file_name:
-            self._note.export_to_word(file_name)
+            track_export(self._exporter.export(self._menu_item.note, file_name, 'docx'),
+                         'export to word', self)
+
+    @Slot() #type: ignore
+    def _on_export_book_trigger(self, format: str):
+        file_name, selected = QFileDialog.getSaveFileName(
+            self, 'export all notes', user_desktop_dir(), 
+            'zip archive (*.zip);;folder (*)')
+        if not file_name:
+            return
+        if selected.startswith('zip') and not file_name.lower().endswith('.zip'):
+            file_name += '.zip'
+        batch = self._exporter.export_book(list(self._book), file_name, format)
+        track_export(batch, 'export all notes', self)
+
+    @Slot()
+    def _on_search_trigger(self):
+        if self._search_bar.isVisible():
+            self._search_edit.clear()
+            self._search_bar.hide()
+            return
+        self._book.prepare_search()
+        self._search_bar.show()
+        self._search_edit.setFocus()
+
+    @Slot()
+    def _on_search(self):
+        query = self._search_edit.text().strip()
+        if not query:
+            for item in self._note_list:
+                item.show()
+            return
+
+        notes = set(self._book.search(query))
+        for item in self._note_list:
+            if isinstance(item, NoteItem):
+                item.setVisible(item.note in notes)
+
+    @Slot()
+    def _on_search_accept(self):
+        query = self._search_edit.text().strip()
+        notes = self._book.search(query) if query else []
+        if notes:
+            self._book.current_note = notes[0]
+
+    @Slot()
+    def _on_side_bar_trigger(self):
+        self.hide()
+        self.side_bar_triggered.emit()
+
+    @Slot()
+    def _on_new_note(self, note: Note):
+        self._note_list.add_item(NoteItem(note, self._note_icon))
+
+        self._note_list.set_active(0)
+
+    def _load(self):
+        self._note_list.add_items(
+            [NoteItem(note, self._note_icon) for note in self._book])
+
+        if self._book:
+            self._note_list.set_active(0)
+
+    @Slot()
+    def _on_note_remove(self, note: Note):
+        note_item = next((x for x in self._note_list 
+            if isinstance(x, NoteItem) and x.note == note), None)
+        if note_item:
+            self._note_list.delete_item(note_item)
+
+    @Slot()
+    def _on_create_note(self):
+        self._book.create_note()
+
+class NoteItem(ListItem):
+    def __init__(self, note: Note, icon: QIcon):
+        super().__init__(note.name, icon)
+        self._note = note
+
+        note.name_changed.connect(self._on_name_change)
+
+    def _on_name_change(self, name: str):
+        self.text = name
 
     @property
     def note(self):
         return self._note
-
-    @override
-    def contextMenuEvent(self, event: QContextMenuEvent):
-        self._more_menu.exec(event.globalPos())
-        super().contextMenuEvent(event)
@@ -58,5 +58,6 @@ class NoteView(QWidget):
         self._browser.reload()
 
     @Slot() #type: ignore
-    def _on_current_note_modify(self, url):
-        self._browser.setUrl(url)
+    def _on_current_note_modify(self, url, patch):
+        if patch is None or not self._browser.patch(url, patch):
+            self._browser.setUrl(url)
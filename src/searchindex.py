@@ -0,0 +1,267 @@
+import math
+import re
+import threading
+from bisect import bisect_left
+from pathlib import Path
+from loguru import logger
+import msgpack
+
+# 中文按单字切分, 连续的字在查询时按短语匹配
+CJK = "\u3400-\u4dbf\u4e00-\u9fff"
+TOKEN = re.compile(f"[{CJK}]|[^\\W{CJK}]+")
+
+def tokenize(text: str) -> list[str]:
+    return TOKEN.findall(text.lower())
+
+def parse_query(query: str, prefix_last=False):
+    """Split the query into clauses of (tokens, prefix).
+
+    "quoted text" and words made of several tokens are phrases, a trailing *
+    makes a prefix term. With prefix_last the word being typed at the end
+    of the query is a prefix term as well.
+    """
+    clauses = []
+    for match in re.finditer(r'"([^"]*)"?|(\S+)', query):
+        if match.group(1) is not None:
+            tokens = tokenize(match.group(1))
+            prefix = False
+        else:
+            word = match.group(2)
+            prefix = word.endswith('*') or (
+                prefix_last and match.end() == len(query))
+            tokens = tokenize(word.rstrip('*'))
+            prefix = prefix and len(tokens) == 1
+        if tokens:
+            clauses.append((tokens, prefix))
+    return clauses
+
+class SearchIndex:
+    """笔记全文索引, 倒排表带词位置, BM25排序
+
+    首次查询时才从磁盘载入, 载入前的更新暂存在内存中.
+    update可在工作线程中调用.
+    """
+    VERSION = 1
+    K1 = 1.2
+    B = 0.75
+    # 前缀展开后计分的词数, 其余的词只匹配不计分
+    MAX_EXPANSIONS = 64
+    # 更短的前缀只匹配完整的词, 单个字母展开会匹配几乎所有文档
+    MIN_PREFIX = 2
+
+    def __init__(self, path: Path):
+        self._path = path
+        self._lock = threading.RLock()
+        self._loaded = False
+        self._dirty = False
+
+        # id -> (hash, 词), 未载入时暂存的更新, None表示删除
+        self._pending: dict[str, tuple[str, list[str]] | None] = {}
+
+        # id -> (hash, 长度, 词表)
+        self._docs: dict[str, tuple[str, int, list[str]]] = {}
+        # 词 -> id -> 位置
+        self._postings: dict[str, dict[str, list[int]]] = {}
+        self._total_length = 0
+        self._vocabulary: list[str] | None = None
+
+    def update(self, id: str, hash: str, text: str):
+        with self._lock:
+            doc = self._docs.get(id)
+            if doc and doc[0] == hash:
+                return
+            tokens = tokenize(text)
+            if not self._loaded:
+                self._pending[id] = (hash, tokens)
+                return
+            self._remove(id)
+            self._add(id, hash, tokens)
+
+    def remove(self, id: str):
+        with self._lock:
+            if not self._loaded:
+                self._pending[id] = None
+                return
+            self._remove(id)
+
+    def hash(self, id: str):
+        with self._lock:
+            self.load()
+            doc = self._docs.get(id)
+            return doc[0] if doc else None
+
+    def load(self):
+        with self._lock:
+            if self._loaded:
+                return
+            try:
+                with open(self._path, 'rb') as file:
+                    data = msgpack.unpackb(file.read())
+                if data.get('version') == self.VERSION:
+                    self._docs = {k: tuple(v) for k, v in data['docs'].items()}
+                    self._postings = data['postings']
+                    self._total_length = sum(x[1] for x in self._docs.values())
+            except FileNotFoundError:
+                ...
+            except Exception as e:
+                logger.warning(f"load search index failed: {str(e)}")
+
+            self._loaded = True
+            for id, pending in self._pending.items():
+                self._remove(id)
+                if pending:
+                    self._add(id, *pending)
+            self._pending.clear()
+
+    def save(self):
+        with self._lock:
+            if self._pending:
+                self.load()
+            if not self._dirty:
+                return
+            data = msgpack.packb({
+                'version': self.VERSION,
+                'docs': self._docs,
+                'postings': self._postings,
+            })
+            self._dirty = False
+        with open(self._path, 'wb') as file:
+            file.write(data) # type: ignore
+
+    @property
+    def loaded(self):
+        return self._loaded
+
+    def search(self, query: str, limit: int | None = 100, 
+               prefix_last=False, wait=True) -> list[tuple[str, float]]:
+        """Returns the ids of matching documents with their scores, best first.
+
+        All clauses of the query must match. Unless wait, nothing is
+        returned while the index is not loaded yet.
+        """
+        clauses = parse_query(query, prefix_last)
+        if not clauses or (not wait and not self._loaded):
+            return []
+
+        with self._lock:
+            self.load()
+
+            scores: dict[str, float] | None = None
+            for tokens, prefix in clauses:
+                if prefix:
+                    matched = self._match_prefix(tokens[0])
+                elif len(tokens) == 1:
+                    matched = self._match_terms([tokens[0]])
+                else:
+                    matched = self._match_phrase(tokens)
+
+                if scores is None:
+                    scores = matched
+                else:
+                    scores = {k: v + matched[k] for k, v in scores.items()
+                        if k in matched}
+                if not scores:
+                    return []
+
+        assert scores is not None
+        return sorted(scores.items(), key=lambda x: -x[1])[:limit]
+
+    def _add(self, id: str, hash: str, tokens: list[str]):
+        positions: dict[str, list[int]] = {}
+        for i, token in enumerate(tokens):
+            positions.setdefault(token, []).append(i)
+        for term, x in positions.items():
+            postings = self._postings.get(term)
+            if postings is None:
+                postings = self._postings[term] = {}
+                self._vocabulary = None
+            postings[id] = x
+        self._docs[id] = (hash, len(tokens), list(positions))
+        self._total_length += len(tokens)
+        self._dirty = True
+
+    def _remove(self, id: str):
+        doc = self._docs.pop(id, None)
+        if doc is None:
+            return
+        for term in doc[2]:
+            postings = self._postings.get(term)
+            if postings is None:
+                continue
+            postings.pop(id, None)
+            if not postings:
+                del self._postings[term]
+                self._vocabulary = None
+        self._total_length -= doc[1]
+        self._dirty = True
+
+    def _score(self, term: str, ids, scores: dict[str, float]):
+        postings = self._postings[term]
+        docs = self._docs
+        count = len(docs)
+        average = self._total_length / count if count else 0
+        idf = math.log(1 + (count - len(postings) + 0.5) / (len(postings) + 0.5))
+        # 循环外算好常数, 前缀展开时每次查询要给上万个文档计分
+        k1, b = self.K1, self.B
+        numerator = idf * (k1 + 1)
+        base = k1 * (1 - b)
+        per_length = k1 * b / (average or 1)
+        get = scores.get
+        for id in ids:
+            tf = len(postings[id])
+            scores[id] = get(id, 0) + numerator * tf / (
+                tf + base + per_length * docs[id][1])
+
+    def _match_terms(self, terms: list[str]):
+        scores = {}
+        for term in terms:
+            postings = self._postings.get(term)
+            if postings:
+                self._score(term, postings, scores)
+        return scores
+
+    def _match_prefix(self, prefix: str):
+        if len(prefix) < self.MIN_PREFIX:
+            return self._match_terms([prefix])
+        if self._vocabulary is None:
+            self._vocabulary = sorted(self._postings)
+        terms = []
+        i = bisect_left(self._vocabulary, prefix)
+        while (i < len(self._vocabulary)
+               and self._vocabulary[i].startswith(prefix)):
+            terms.append(self._vocabulary[i])
+            i += 1
+
+        # 文档数多的词计分, 其余的词不丢弃, 只匹配的文档排在后面
+        terms.sort(key=lambda x: -len(self._postings[x]))
+        scores = self._match_terms(terms[:self.MAX_EXPANSIONS])
+        rest = set()
+        for term in terms[self.MAX_EXPANSIONS:]:
+            rest.update(self._postings[term])
+        for id in rest - scores.keys():
+            scores[id] = 0.0
+        return scores
+
+    def _match_phrase(self, tokens: list[str]):
+        postings = [self._postings.get(x) for x in tokens]
+        if not all(postings):
+            return {}
+        # 从最短的倒排表开始求交
+        ids = set(min(postings, key=len)) # type: ignore
+        for x in postings:
+            ids &= x.keys() # type: ignore
+
+        matched = set()
+        for id in ids:
+            starts = set(postings[0][id]) # type: ignore
+            for offset, x in enumerate(postings[1:], 1):
+                starts &= {p - offset for p in x[id]} # type: ignore
+                if not starts:
+                    break
+            if starts:
+                matched.add(id)
+
+        scores = {}
+        for term in tokens:
+            self._score(term, matched, scores)
+        return scores
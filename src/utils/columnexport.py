@@ -0,0 +1,84 @@
+# 把从sqlite读出的列转为numpy数组, 用于统计分析, 不创建实例
+# * 数值, 日期, 时长, 布尔转为对应的numpy类型, None用掩码标记
+# * TEXT, BLOB为object数组
+# * 引用为id
+import numpy as np
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+# 属性类型 -> numpy类型
+DTYPES = {
+    'INTEGER': np.dtype('int64'),
+    'REAL': np.dtype('float64'),
+    'date': np.dtype('datetime64[D]'),
+    'datetime': np.dtype('datetime64[us]'),
+    'timedelta': np.dtype('timedelta64[us]'),
+    'bool': np.dtype('bool'),
+}
+
+def column_dtype(dtype: str, reference: bool):
+    if reference:
+        return DTYPES['INTEGER']
+    return DTYPES.get(dtype, np.dtype(object))
+
+def to_array(values: list, dtype: str, reference=False):
+    """Raw sqlite values of a column as an array of the property type.
+
+    Typed columns are masked arrays with None masked, others are object
+    arrays keeping None.
+    """
+    target = column_dtype(dtype, reference)
+    if target == object:
+        array = np.empty(len(values), object)
+        array[:] = values
+        return array
+
+    mask = np.fromiter((x is None for x in values), bool, len(values))
+    if dtype == 'timedelta':
+        # 以秒保存
+        seconds = np.array([0.0 if x is None else x for x in values], float)
+        data = np.round(seconds * 1e6).astype(np.int64).view(target)
+    elif target.kind == 'M':
+        # iso格式的字符串, None转为NaT
+        data = np.array(values, target)
+    else:
+        data = np.array([0 if x is None else x for x in values]
+            if mask.any() else values, target)
+    return np.ma.MaskedArray(data, mask=mask)
+
+def fill_value(dtype: np.dtype):
+    match dtype.kind:
+        case 'f':
+            return np.nan
+        case 'M' | 'm':
+            return dtype.type('NaT')
+        case 'b':
+            return False
+        case 'O':
+            return None
+        case _:
+            return 0
+
+def to_structured(columns: dict[str, np.ndarray]):
+    """Columns as a structured array, None as NaN, NaT, 0 or False."""
+    size = len(next(iter(columns.values()))) if columns else 0
+    result = np.empty(size, [(k, v.dtype) for k, v in columns.items()])
+    for name, array in columns.items():
+        result[name] = np.ma.filled(array, fill_value(array.dtype)) \
+            if isinstance(array, np.ma.MaskedArray) else array
+    return result
+
+def to_table(columns: dict[str, np.ndarray]):
+    """Columns as a pyarrow table, masked values become nulls."""
+    assert pyarrow, "pyarrow is not installed"
+    arrays = {}
+    for name, array in columns.items():
+        if isinstance(array, np.ma.MaskedArray):
+            arrays[name] = pyarrow.array(
+                array.data, mask=np.ma.getmaskarray(array))
+        else:
+            arrays[name] = pyarrow.array(array, from_pandas=True)
+    return pyarrow.table(arrays)
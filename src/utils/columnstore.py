@@ -0,0 +1,137 @@
+# 按列保存属性, 供PropertyMeta的storage='columns'使用
+# * INTEGER, REAL存于numpy数组, 另有一列标记是否为None
+# * 其余类型存于列表
+import numpy as np
+
+NUMERIC = {
+    'INTEGER': np.int64,
+    'REAL': np.float64,
+}
+
+def extend(array: np.ndarray, capacity: int):
+    result = np.zeros(capacity, array.dtype)
+    result[:len(array)] = array
+    return result
+
+class Row:
+    """实例的属性存储, 代替_properties字典, 键为'_'加属性名"""
+    __slots__ = ('store', 'row')
+
+    def __init__(self, store: 'ColumnStore', row: int):
+        self.store = store
+        self.row = row
+
+    def get(self, key, default=None):
+        value = self.store.get(self.row, key)
+        return default if value is None else value
+
+    def __getitem__(self, key):
+        return self.store.get(self.row, key)
+
+    def __setitem__(self, key, value):
+        self.store.set(self.row, key, value)
+
+    def update(self, items):
+        for key, value in items:
+            self.store.set(self.row, key, value)
+
+    def __del__(self):
+        # 实例释放后行可复用
+        self.store.release(self.row)
+
+class ColumnStore:
+    """一个类所有实例的属性值, 每个实例占一行
+
+    删除的行标记为无效, 实例释放后行被复用. 容量不足时列整体扩容,
+    之前取得的列视图不再随之更新.
+    """
+    CAPACITY = 1024
+
+    def __init__(self, description: dict[str, str]):
+        self._size = 0
+        self._capacity = self.CAPACITY
+        self._alive = np.zeros(self._capacity, bool)
+        # 已释放可复用的行
+        self._free: list[int] = []
+        # 数值列: (值, 是否非None); 其他列: 列表
+        self._numeric: dict[str, tuple[np.ndarray, np.ndarray]] = {}
+        self._objects: dict[str, list] = {}
+        for name, dtype in description.items():
+            key = f'_{name}'
+            if dtype in NUMERIC:
+                self._numeric[key] = (
+                    np.zeros(self._capacity, NUMERIC[dtype]),
+                    np.zeros(self._capacity, bool))
+            else:
+                self._objects[key] = []
+
+    def __len__(self):
+        return self._size - len(self._free)
+
+    def allocate(self):
+        if self._free:
+            row = self._free.pop()
+            self._alive[row] = True
+            return Row(self, row)
+        if self._size == self._capacity:
+            self._grow()
+        row = self._size
+        self._size += 1
+        self._alive[row] = True
+        for column in self._objects.values():
+            column.append(None)
+        return Row(self, row)
+
+    def release(self, row: int):
+        self._alive[row] = False
+        for values, valid in self._numeric.values():
+            valid[row] = False
+        for column in self._objects.values():
+            column[row] = None
+        self._free.append(row)
+
+    def set_alive(self, row: int, alive: bool):
+        self._alive[row] = alive
+
+    def get(self, row: int, key: str):
+        column = self._numeric.get(key)
+        if column is None:
+            return self._objects[key][row]
+        values, valid = column
+        # 转回python类型, 与字典存储的行为一致
+        return values[row].item() if valid[row] else None
+
+    def set(self, row: int, key: str, value):
+        column = self._numeric.get(key)
+        if column is None:
+            self._objects[key][row] = value
+            return
+        values, valid = column
+        if value is None:
+            valid[row] = False
+        else:
+            values[row] = value
+            valid[row] = True
+
+    def column(self, name: str):
+        """All live values of a column.
+
+        Numeric columns are masked arrays viewing the storage without
+        copying, None and deleted rows are masked. Other columns are lists.
+        """
+        key = f'_{name}'
+        alive = self._alive[:self._size]
+        column = self._numeric.get(key)
+        if column is None:
+            return [x for x, y in zip(self._objects[key], alive) if y]
+        values, valid = column
+        return np.ma.MaskedArray(values[:self._size],
+            mask=~(valid[:self._size] & alive))
+
+    def _grow(self):
+        self._capacity *= 2
+        self._alive = extend(self._alive, self._capacity)
+        for key, (values, valid) in self._numeric.items():
+            self._numeric[key] = (
+                extend(values, self._capacity),
+                extend(valid, self._capacity))
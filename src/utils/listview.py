@@ -1,9 +1,23 @@
-from PySide6.QtGui import QMouseEvent
-from PySide6.QtCore import Qt, Signal
+from PySide6.QtGui import QContextMenuEvent, QIcon, QMouseEvent
+from PySide6.QtCore import (
+    QAbstractListModel,
+    QItemSelectionModel,
+    QModelIndex,
+    QPoint,
+    QRect,
+    QSize,
+    Qt,
+    Signal,
+)
 from PySide6.QtWidgets import (
+    QAbstractItemView,
+    QFrame,
     QHBoxLayout,
     QLabel
+    , QListView
     , QScrollArea
+    , QStyle
+    , QStyledItemDelegate
     , QVBoxLayout
     , QWidget
 )
@@ -154,6 +168,14 @@ class Scene(QWidget):
 
         return new_item
 
+    def add_items(self, items: list[Item]):
+        for item in items:
+            self.add_item(item)
+
+    def set_table_style(self):
+        self._layout.setSpacing(0)
+        self._layout.setContentsMargins(0, 0, 0, 0)
+
     def _on_item_active_change(self, flag):
         if flag:
             item = self.sender()
@@ -163,16 +185,276 @@ class Scene(QWidget):
     def set_active(self, id: int):
         self.current_item = self[id]
 
+class ListItem:
+    """虚拟列表中的一行, 只保存数据, 由ItemDelegate绘制"""
+    def __init__(self, text: str='', icon: QIcon|None=None):
+        self._scene: 'VirtualScene|None' = None
+        self._text = text
+        self._icon = icon
+
+    @property
+    def id(self):
+        return self._scene.row(self) if self._scene else -1
+
+    @property
+    def text(self):
+        return self._text
+    @text.setter
+    def text(self, value: str):
+        self._text = value
+        if self._scene:
+            self._scene.update_item(self)
+
+    @property
+    def icon(self):
+        return self._icon
+
+    @property
+    def active(self):
+        return self._scene is not None and self._scene.current_item is self
+    @active.setter
+    def active(self, flag):
+        if self._scene is None:
+            return
+        if flag:
+            self._scene.current_item = self
+        elif self.active:
+            self._scene.current_item = None
+
+    def setVisible(self, flag: bool):
+        if self._scene:
+            self._scene.setRowHidden(self.id, not flag)
+
+    def show(self):
+        self.setVisible(True)
+
+    def hide(self):
+        self.setVisible(False)
+
+class ListModel(QAbstractListModel):
+    def __init__(self):
+        super().__init__()
+        self.items: list[ListItem] = []
+        # 项 -> 行号, 增删后失效, 用到时重建
+        self._rows: dict[ListItem, int] | None = None
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.items)
+
+    def data(self, index, role=Qt.ItemDataRole.DisplayRole):
+        if not index.isValid():
+            return None
+        item = self.items[index.row()]
+        if role == Qt.ItemDataRole.DisplayRole:
+            return item.text
+        if role == Qt.ItemDataRole.DecorationRole:
+            return item.icon
+        return None
+
+    def row(self, item: ListItem):
+        if self._rows is None:
+            self._rows = {x: i for i, x in enumerate(self.items)}
+        return self._rows.get(item, -1)
+
+    def insert(self, row: int, items: list[ListItem]):
+        if not items:
+            return
+        self.beginInsertRows(QModelIndex(), row, row+len(items)-1)
+        self.items[row:row] = items
+        self._rows = None
+        self.endInsertRows()
+
+    def remove(self, first: int, last: int):
+        self.beginRemoveRows(QModelIndex(), first, last)
+        del self.items[first:last+1]
+        self._rows = None
+        self.endRemoveRows()
+
+    def update(self, item: ListItem):
+        index = self.index(self.row(item))
+        self.dataChanged.emit(index, index)
+
+class ItemDelegate(QStyledItemDelegate):
+    """绘制一行, 悬停或选中的行在右侧显示菜单按钮"""
+    HEIGHT = 40
+    ICON_SIZE = 24
+    MARGIN = 8
+
+    def __init__(self, parent, menu_icon: QIcon|None):
+        super().__init__(parent)
+        self.menu_icon = menu_icon
+
+    def sizeHint(self, option, index):
+        return QSize(super().sizeHint(option, index).width(), self.HEIGHT)
+
+    def paint(self, painter, option, index):
+        super().paint(painter, option, index)
+        state = option.state # type: ignore
+        if self.menu_icon and state & (
+            QStyle.StateFlag.State_MouseOver | QStyle.StateFlag.State_Selected):
+            self.menu_icon.paint(painter, self.menu_rect(option.rect)) # type: ignore
+
+    def menu_rect(self, rect: QRect):
+        return QRect(
+            rect.right() - self.MARGIN - self.ICON_SIZE,
+            rect.center().y() - self.ICON_SIZE // 2,
+            self.ICON_SIZE, self.ICON_SIZE)
+
+class VirtualScene(QListView):
+    """Scene的虚拟模式, 行由ListModel保存, 只绘制可见的行"""
+    item_changed = Signal(object)
+    menu_requested = Signal(object, QPoint)
+    def __init__(self, orientation, reversed, menu_icon: QIcon|None=None):
+        super().__init__()
+        self._reversed = reversed
+        self._current_item: ListItem|None = None
+
+        self._model = ListModel()
+        self._delegate = ItemDelegate(self, menu_icon)
+        self.setModel(self._model)
+        self.setItemDelegate(self._delegate)
+
+        self.setFrameShape(QFrame.Shape.NoFrame)
+        self.setSelectionMode(QAbstractItemView.SelectionMode.SingleSelection)
+        self.setEditTriggers(QAbstractItemView.EditTrigger.NoEditTriggers)
+        self.setMouseTracking(True)
+        self.set_orientation(orientation)
+
+        self.selectionModel().currentChanged.connect(self._on_current_change)
+
+    def __iter__(self):
+        return iter(self._model.items)
+
+    def __bool__(self):
+        return bool(self._model.items)
+
+    def __len__(self) -> int:
+        return len(self._model.items)
+
+    def __getitem__(self, id: int):
+        if id > len(self._model.items)-1:
+            return None
+        return self._model.items[id]
+
+    def row(self, item: ListItem):
+        return self._model.row(item)
+
+    def update_item(self, item: ListItem):
+        self._model.update(item)
+
+    @property
+    def current_item(self):
+        return self._current_item
+    @current_item.setter
+    def current_item(self, value: ListItem|None):
+        if self._current_item is value:
+            return
+        self._current_item = value
+        if value is None:
+            self.selectionModel().clear()
+        else:
+            index = self._model.index(value.id)
+            self.selectionModel().setCurrentIndex(
+                index, QItemSelectionModel.SelectionFlag.ClearAndSelect)
+            self.scrollTo(index)
+        self.item_changed.emit(value)
+
+    def set_orientation(self, orientation: Qt.Orientation):
+        vertical = orientation == Qt.Orientation.Vertical
+        self.setFlow(QListView.Flow.TopToBottom if vertical
+            else QListView.Flow.LeftToRight)
+        # 横向时各项宽度随文字变化
+        self.setUniformItemSizes(vertical)
+
+    def delete_item(self, item: ListItem):
+        row = self.row(item)
+        if row >= 0:
+            self._remove(row, row)
+
+    def delete_next(self, item: ListItem):
+        if item.id+1 > len(self)-1:
+            return
+        self._remove(item.id+1, len(self)-1)
+
+    def delete_previous(self, item: ListItem):
+        if item.id > 0:
+            self._remove(0, item.id-1)
+
+    def add_item(self, new_item: ListItem):
+        self.add_items([new_item])
+        return new_item
+
+    def add_items(self, items: list[ListItem]):
+        for item in items:
+            item._scene = self
+        if self._reversed:
+            self._model.insert(0, items[::-1])
+        else:
+            self._model.insert(len(self), list(items))
+
+    def set_active(self, id: int):
+        self.current_item = self[id]
+
+    def set_table_style(self):
+        self.setSpacing(0)
+        self.setContentsMargins(0, 0, 0, 0)
+
+    def _remove(self, first: int, last: int):
+        items = self._model.items
+        removed = items[first:last+1]
+        # 与Scene一致, 删除当前项后第一项成为当前项
+        if self._current_item in removed:
+            rest = items[:first] + items[last+1:]
+            self.current_item = rest[0] if rest else None
+        self._model.remove(first, last)
+        for item in removed:
+            item._scene = None
+
+    def _on_current_change(self, current: QModelIndex, _):
+        self.current_item = (
+            self._model.items[current.row()] if current.isValid() else None)
+
+    def _item_at(self, pos: QPoint):
+        index = self.indexAt(pos)
+        return self._model.items[index.row()] if index.isValid() else None
+
+    @override
+    def mousePressEvent(self, event: QMouseEvent) -> None:
+        pos = event.position().toPoint()
+        index = self.indexAt(pos)
+        if (self._delegate.menu_icon and index.isValid() and
+            self._delegate.menu_rect(self.visualRect(index)).contains(pos)):
+            self.menu_requested.emit(
+                self._model.items[index.row()], event.globalPosition().toPoint())
+            return
+        super().mousePressEvent(event)
+
+    @override
+    def contextMenuEvent(self, event: QContextMenuEvent) -> None:
+        item = self._item_at(event.pos())
+        if item:
+            self.menu_requested.emit(item, event.globalPos())
+
 class ListView(QScrollArea):
-    item_changed = Signal(Item)
+    """列表, virtual为True时使用模型和代理, 只绘制可见的行
+
+    普通模式的项为Item控件, 虚拟模式的项为ListItem, 菜单由menu_requested
+    交给使用者弹出.
+    """
+    item_changed = Signal(object)
+    menu_requested = Signal(object, QPoint)
     def __init__(
         self
         , orientation: Qt.Orientation=Qt.Orientation.Vertical
         , reversed=True
+        , virtual=False
+        , menu_icon: QIcon|None=None
     ):
         super().__init__()
         self._orientation = orientation
         self._reversed = reversed 
+        self._virtual = virtual
+        self._menu_icon = menu_icon
         self.setWidgetResizable(True)
         self._add_scene()
 
@@ -206,29 +488,36 @@ class ListView(QScrollArea):
         self._scene.set_orientation(orientation);
 
     def _add_scene(self):
-        self._scene = Scene(self._orientation, self._reversed)
+        if self._virtual:
+            self._scene = VirtualScene(
+                self._orientation, self._reversed, self._menu_icon)
+            self._scene.menu_requested.connect(self.menu_requested)
+        else:
+            self._scene = Scene(self._orientation, self._reversed)
         self.setWidget(self._scene)
         def on_item_change(item):
             self.item_changed.emit(item)
         self._scene.item_changed.connect(on_item_change)
 
     def set_table_style(self):
-        self._scene._layout.setSpacing(0)
-        self._scene._layout.setContentsMargins(0, 0, 0, 0)
+        self._scene.set_table_style()
 
     def set_active(self, id: int):
         self._scene.set_active(id)
 
-    def add_item(self, item: Item):
+    def add_item(self, item):
         return self._scene.add_item(item)
 
-    def delete_item(self, item: Item):
+    def add_items(self, items: list):
+        self._scene.add_items(items)
+
+    def delete_item(self, item):
         self._scene.delete_item(item)
 
-    def delete_previous(self, item: Item):
+    def delete_previous(self, item):
         self._scene.delete_previous(item)
 
-    def delete_next(self, item: Item):
+    def delete_next(self, item):
         self._scene.delete_next(item)
 
     def clear(self):
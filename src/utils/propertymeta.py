@@ -3,13 +3,21 @@
 # * 数据库映射
 # 我们扩展了一些类型的注册
 from uuid import uuid4
-from PySide6.QtCore import QObject, Signal
+from PySide6.QtCore import QObject, QTimer, Signal, Slot
+from contextlib import closing, contextmanager
 from enum import Enum
+import json
+import queue
 import sqlite3
+import threading
+import weakref
 import datetime
 
 from loguru import logger
 
+from utils.columnexport import to_array, to_structured, to_table
+from utils.columnstore import ColumnStore
+
 DBStatus = Enum('DBStatus', ['IDLE', 'INSERT', 'UPDATE', 'DELETE'])
 
 def adapt_date_iso(val):
@@ -50,14 +58,175 @@ sqlite3.register_converter("datetime", convert_datetime)
 sqlite3.register_converter("timedelta", convert_timedelta)
 sqlite3.register_converter("bool", convert_bool)
 
+def index_definition(table, description, columns, unique):
+    if isinstance(columns, str):
+        columns = (columns,)
+    columns = tuple(columns)
+    for column in columns:
+        assert column in description, f"unknown index column: {column}"
+    prefix = 'uidx' if unique else 'idx'
+    return (f"{prefix}_{table}_{'_'.join(columns)}", columns, unique)
+
+# 类型检测, 在类定义前设为False可省去检测, 默认随python -O关闭
+VALIDATE = __debug__
+
+# 属性类型 -> python类型, 其余类型(引用)按类名检测
+TYPES = {
+    'TEXT': str,
+    'INTEGER': int,
+    'REAL': float,
+    'BLOB': bytes,
+    'date': datetime.date,
+    'datetime': datetime.datetime,
+    'timedelta': datetime.timedelta,
+    'bool': bool,
+}
+
+class Dangling(int):
+    """引用的行不存在时保存的id, 访问时不再查询数据库, 直到重新赋值"""
+    __slots__ = ()
+
+ACCESSORS = """
+def make(key, name, required, signal):
+{getter}
+
+    def setter(self, value):
+{check}
+        properties = self._properties
+        if {current} == value:
+            return
+        properties[key] = value
+        # 记录变动的列, 保存时只更新这些列, 插入时写入所有列
+        status = self._db_status
+        if status is not DBStatus.INSERT:
+            self._changed.add(name)
+            if status is not DBStatus.UPDATE:
+                self.db_status = DBStatus.UPDATE
+        # 批量修改时合并信号, 结束时统一发出
+        if _batch_depth:
+            _batched.setdefault(self, set()).add(name)
+            return
+{emit}
+        self.properties_changed.emit({{name}})
+        self.changed.emit()
+
+    return getter, setter
+"""
+
+GETTER = """
+    def getter(self):
+        return self._properties.get(key)
+"""
+
+# 引用列载入时只保存id, 首次访问时经id表解析
+GETTER_REFERENCE = """
+    def getter(self):
+        properties = self._properties
+        value = properties.get(key)
+        if value.__class__ is int:
+            resolved = _resolve(required, value)
+            if resolved is None:
+                properties[key] = Dangling(value)
+                return None
+            properties[key] = value = resolved
+        elif value.__class__ is Dangling:
+            # 之后在内存中创建的实例仍可经id表找到
+            resolved = PropertyMeta.classes[required].get(value)
+            if resolved is not None:
+                properties[key] = resolved
+            return resolved
+        return value
+"""
+
+CHECK_TYPE = """
+        if value.__class__ is not required and value is not None:
+            raise AssertionError(f"wrong type: {type(value)}, required: "
+                f"{required.__name__}, value: {value}")
+"""
+
+CHECK_NAME = """
+        if value.__class__.__name__ != required and value is not None:
+            raise AssertionError(f"wrong type: {type(value)}, required: "
+                f"{required}, value: {value}")
+"""
+
+EMIT = """
+        getattr(self, signal).emit()
+"""
+
+def make_accessors(name: str, dtype: str, signal: str | None):
+    """Generate the getter and setter of a property.
+
+    The type check, the key and the signal name are bound in the generated
+    code, the type check is left out unless VALIDATE.
+    """
+    required = TYPES.get(dtype, dtype)
+    # 其余类型为引用, 以类名表示
+    reference = isinstance(required, str)
+    check = ''
+    if VALIDATE:
+        check = CHECK_NAME if reference else CHECK_TYPE
+    source = ACCESSORS.format(
+        getter=(GETTER_REFERENCE if reference else GETTER).strip('\n'),
+        current='getter(self)' if reference else 'properties.get(key)',
+        check=check.strip('\n'), emit=EMIT.strip('\n') if signal else '')
+    namespace = {}
+    # 以模块为全局命名空间, 生成的代码可读取批量修改的状态
+    exec(compile(source, f'<{name} accessors>', 'exec'), globals(), namespace)
+    return namespace['make'](f'_{name}', name, required, signal)
+
+class Instances:
+    """类的实例集合, 只持有弱引用, 加入和移除都是O(1)"""
+    def __init__(self):
+        self._refs = weakref.WeakValueDictionary()
+
+    def add(self, ins):
+        self._refs[id(ins)] = ins
+
+    def discard(self, ins):
+        if self._refs.get(id(ins)) is ins:
+            del self._refs[id(ins)]
+
+    def __contains__(self, ins):
+        return self._refs.get(id(ins)) is ins
+
+    def __iter__(self):
+        # 遍历期间实例可能被释放或新建
+        return iter(list(self._refs.values()))
+
+    def __len__(self):
+        return len(self._refs)
+
 class PropertyMeta(type(QObject)):
     registry = []
-    def __new__(cls, name, bases, dct, description):
+    # 类名 -> 类, 解析引用用
+    classes = {}
+    def __new__(cls, name, bases, dct, description, indexes=(), 
+                unique_indexes=(), storage='dict'):
         # cls是PropertyMeta对象, type的一个实例,
         # cls_instance是Class的对象, PropertyMeta的一个实例
+        # storage='columns'时属性值按列存于ColumnStore, 实例只持有行号,
+        # 且没有<prop>_changed信号
         dct['description'] = description
-        # 类实例集合
-        dct['inses'] = []
+        # 索引, 单列为列名, 多列为列名的元组: (索引名, 列, 是否唯一)
+        dct['indexes'] = [
+            index_definition(name, description, x, unique)
+            for unique, xs in ((False, indexes), (True, unique_indexes))
+            for x in xs
+        ]
+        # 属性存储, 'dict'时每个实例一个字典, 'columns'时全部实例按列存放
+        assert storage in ('dict', 'columns'), f"unknown storage: {storage}"
+        dct['store'] = ColumnStore(description) if storage == 'columns' else None
+        # 类实例集合, 只持有弱引用, 不再使用的实例随之释放
+        dct['inses'] = Instances()
+        # id -> 实例, 未删除的实例
+        dct['identities'] = weakref.WeakValueDictionary()
+        # 待保存(插入, 更新, 删除)的实例, 保存前不能释放
+        dct['dirty'] = set()
+        # 已标记删除, 但数据库中可能仍存在的id, 查询和载入时跳过, 写入后移除
+        dct['deleted'] = set()
+        # 常驻内存的实例, 全部载入时包括所有实例
+        dct['pinned'] = set()
         # 所有信号, 包含用户自定义的信号
         signals = {k: v for k, v in dct.items() if isinstance(v, Signal)}
         # 属性变动信号, 自动生成
@@ -66,54 +235,25 @@ class PropertyMeta(type(QObject)):
         cls_instance = super().__new__(cls, name, bases, dct)
         # 注册类对象
         cls.registry.append(cls_instance)
+        cls.classes[name] = cls_instance
 
-        # 反射get和set方法
-        def add_property(property_name, dtype):
-            def type_name(dtype):
-                match dtype:
-                    case 'TEXT':
-                        return str.__name__
-                    case 'INTEGER':
-                        return int.__name__
-                    case 'REAL':
-                        return float.__name__
-                    case 'BLOB':
-                        return bytes.__name__
-                    case 'date':
-                        return datetime.date.__name__
-                    case 'datetime':
-                        return datetime.datetime.__name__
-                    case 'timedelta':
-                        return datetime.timedelta.__name__
-                    case _:
-                        return dtype
-
-            #私有成员
-            private_name = "_" + property_name
-            def getter(self):
-                return self._properties.get(private_name)
-
-            def setter(self, value):
-                # 强类型检测
-                assert (
-                    type(value).__name__ == type_name(dtype) or value == None
-                ), f"wrong type: {type(value)}, required: {type_name(dtype)}, value: {value}"
-                if self._properties.get(private_name) == value:
-                    return
-                self._properties[private_name] = value
-                if self.db_status != DBStatus.INSERT:
-                    self.db_status = DBStatus.UPDATE
-                signal = getattr(self, f"{property_name}_changed")
-                assert signal
-                signal.emit()
-                self.changed.emit()
+        columns = dct['store'] is not None
 
+        # 生成get和set方法
+        def add_property(property_name, dtype):
+            signal_name = None
+            # 按列存储时不为每个属性添加信号, QObject初始化时每个信号都要
+            # 创建实例, 改用properties_changed
+            if not columns:
+                # 添加属性变动的信号
+                signal_name = f'{property_name}_changed'
+                signal = Signal()
+                setattr(cls_instance, signal_name, signal)
+                signals.update({signal_name: signal})
+                changed_signals.update({signal_name: signal})
+
+            getter, setter = make_accessors(property_name, dtype, signal_name)
             setattr(cls_instance, property_name, property(getter, setter))
-            # 添加属性变动的信号
-            signal = Signal()
-            setattr(cls_instance, f'{property_name}_changed', signal)
-            signals.update({f'{property_name}_changed': signal})
-            changed_signals.update({f'{property_name}_changed': signal})
 
         for property_name, dtype in description.items():
             add_property(property_name, dtype)
@@ -124,21 +264,71 @@ class PropertyMeta(type(QObject)):
             def setter(self, value):
                 setattr(self, f'_{name}', value)
             setattr(cls_instance, name, property(getter, setter))
-        # 增加额外的属性维护数据库状态
-        add_inner_property('id')
-        add_inner_property('db_status')
-
+        # 增加额外的属性维护数据库状态, id和删除状态同步到id表
+        identities = dct['identities']
+        dirty = dct['dirty']
+        deleted = dct['deleted']
+        def get_id(self):
+            return self._id
+        def set_id(self, value):
+            old = getattr(self, '_id', None)
+            if identities.get(old) is self:
+                del identities[old]
+            self._id = value
+            if self.db_status != DBStatus.DELETE:
+                identities[value] = self
+            else:
+                deleted.discard(old)
+                deleted.add(value)
+        setattr(cls_instance, 'id', property(get_id, set_id))
+
+        def get_db_status(self):
+            return self._db_status
+        store = dct['store']
+        def set_db_status(self, value):
+            self._db_status = value
+            if store is not None:
+                store.set_alive(self._properties.row, value != DBStatus.DELETE)
+            if value == DBStatus.IDLE:
+                dirty.discard(self)
+                self._changed.clear()
+            else:
+                dirty.add(self)
+            id = getattr(self, '_id', None)
+            if value == DBStatus.DELETE:
+                if identities.get(id) is self:
+                    del identities[id]
+                if id is not None:
+                    deleted.add(id)
+            elif id is not None:
+                identities[id] = self
+                deleted.discard(id)
+        setattr(cls_instance, 'db_status', property(get_db_status, set_db_status))
+
+        # 属性在_properties中的键, 按description的顺序
+        setattr(cls_instance, 'private_names', 
+            tuple(f'_{x}' for x in description))
         setattr(cls_instance, 'signals', signals)
         setattr(cls_instance, 'changed_signals', changed_signals)
         setattr(cls_instance, 'changed', Signal())
+        # 变动的属性名集合, 批量修改时只发出一次
+        setattr(cls_instance, 'properties_changed', Signal(object))
+
+        def update(self, **fields):
+            """Assign several properties, change signals are emitted once."""
+            for k in fields:
+                assert k in description, f"unknown property: {k}"
+            with batch():
+                for k, v in fields.items():
+                    setattr(self, k, v)
+        setattr(cls_instance, 'update', update)
 
         def adapt(val):
             return val.id
 
         def converter(val):
             # note: 虽然adapt表明id为int, 但是这里的val却是bytes, 需要强制转换
-            # load确保所有实例都已经完成初始化
-            return next(x for x in dct['inses'] if x.id == int(val))
+            return _resolve(name, int(val))
 
         # 注册转换器
         sqlite3.register_adapter(cls_instance, adapt)
@@ -147,89 +337,631 @@ class PropertyMeta(type(QObject)):
         return cls_instance
 
     def __call__(cls, *args, **kwds):
+        # 32位的随机id在数万行时就可能重复
+        id = uuid4().int%(1<<32)
+        while id in cls.identities:
+            id = uuid4().int%(1<<32)
+        ins = cls._construct(id, DBStatus.INSERT, args, kwds)
+        if _pin:
+            cls.pinned.add(ins)
+        return ins
+
+    def _construct(cls, id, db_status, args=(), kwds={}):
         ins = cls.__new__(cls, *args, **kwds) #type: ignore
         # 添加属性集合
-        setattr(ins, '_properties', {})
-        setattr(ins, 'id', uuid4().int%(1<<32))
-        setattr(ins, 'db_status', DBStatus.INSERT)
+        setattr(ins, '_properties', 
+            cls.store.allocate() if cls.store is not None else {})
+        setattr(ins, '_changed', set())
+        # 直接写入id和状态, 省去setter
+        setattr(ins, '_db_status', db_status)
+        setattr(ins, '_id', id)
+        cls.identities[id] = ins
+        if db_status != DBStatus.IDLE:
+            cls.dirty.add(ins)
         if isinstance(ins, cls):
             ins.__init__(*args, **kwds)
-        inses = getattr(cls, 'inses')
-        inses.append(ins)
+        cls.inses.add(ins)
         return ins
 
-# 数据库载入
-def load(path):
-    with sqlite3.connect(path, detect_types=sqlite3.PARSE_DECLTYPES) as con:
-        cur = con.cursor()
-        for cls in PropertyMeta.registry:
-            cols = "id INTEGER PRIMARY KEY"
-            cols += "".join([f", {col} {dtype}" 
-                for col, dtype in cls.description.items()])
-            cls_name = cls.__name__
-            cur.execute(f"CREATE TABLE IF NOT EXISTS {cls_name}({cols})")
-            # 创建所有实例
-            for row in cur.execute(f"SELECT id FROM {cls_name}"):
-                ins = cls()
-                ins.db_status = DBStatus.IDLE
-                ins.id = row[0]
-        con.commit()
-
-        for cls in PropertyMeta.registry:
-            cls_name = cls.__name__
-            # 实例设置属性, 实例间存在引用关系, 故需先全部实例化
-            for ins, row in zip(
-                cls.inses
-                , cur.execute(f"SELECT * FROM {cls_name}").fetchall()
-            ):
-                for k, v in zip(cls.description, row[1:]):
-                    setattr(ins, k, v)
-                convert = getattr(ins, 'convert', None)
-                if convert:
-                    convert()
-# 数据库保存
-def save(path):
-    with sqlite3.connect(path) as con:
-        def filter(cls, status):
-            return [x for x in cls.inses if x.db_status == status]
-
-        cur = con.cursor()
-        for cls in PropertyMeta.registry:
-            to_insert = filter(cls, DBStatus.INSERT)
-            to_delete = filter(cls, DBStatus.DELETE)
-            to_update = filter(cls, DBStatus.UPDATE)
-            cls_name = cls.__name__
-
+    def pin(cls, ins):
+        """Keep the instance in memory while it is not referenced."""
+        cls.pinned.add(ins)
+
+    def unpin(cls, ins):
+        cls.pinned.discard(ins)
+
+    def get(cls, id):
+        """The instance with the id, None if there is none or it is deleted."""
+        return cls.identities.get(id)
+
+    def query(cls):
+        return Query(cls)
+
+    def prefetch(cls, inses, *names: str):
+        """Resolve the references of the instances, one query per relation."""
+        # sqlite限制单条语句的参数个数
+        chunk = 900
+        for name in names:
+            reference = PropertyMeta.classes.get(cls.description.get(name))
+            assert reference, f"not a reference: {name}"
+            key = f'_{name}'
+            ids = {x._properties.get(key) for x in inses}
+            missing = [x for x in ids 
+                if x.__class__ is int and reference.get(x) is None]
+            # 持有查询到的实例, 直到引用被解析
+            fetched = []
+            for i in range(0, len(missing), chunk):
+                fetched.extend(reference.query().where(
+                    'id', 'in', missing[i:i+chunk]))
+            for x in inses:
+                value = x._properties.get(key)
+                if value.__class__ is int:
+                    resolved = reference.get(value)
+                    x._properties[key] = (Dangling(value) if resolved is None 
+                        else resolved)
+
+    def to_columns(cls, *names: str):
+        return cls.query().to_columns(*names)
+
+    def to_numpy(cls, *names: str):
+        return cls.query().to_numpy(*names)
+
+    def to_arrow(cls, *names: str):
+        return cls.query().to_arrow(*names)
+
+    def column(cls, name: str):
+        """Values of a property for all instances not deleted.
+
+        With storage='columns' INTEGER and REAL columns are masked numpy
+        arrays viewing the storage.
+        """
+        assert name in cls.description, f"unknown property: {name}"
+        if cls.store is not None:
+            return cls.store.column(name)
+        return [x._properties.get(f'_{name}') for x in cls.inses 
+            if x.db_status != DBStatus.DELETE]
+
+class Query:
+    """按条件查询数据库中的实例, 逐页读取, 实例经id表按需创建
+
+    Query是不可变的, where等方法返回新的查询:
+
+        Patient.query().where(name='x').where('age', '>', 3).order_by('-age').limit(10)
+
+    条件和排序由sqlite执行, 类声明了相应的indexes时走索引.
+    引用列在访问时才解析, prefetch的引用按页一次查询.
+    """
+    PAGE_SIZE = 512
+    OPERATORS = ('=', '!=', '<', '<=', '>', '>=', 'LIKE', 'IN', 'NOT IN')
+
+    def __init__(self, cls):
+        self._cls = cls
+        self._where: list[tuple[str, str, object]] = []
+        self._order: list[str] = []
+        self._limit: int | None = None
+        self._offset = 0
+        self._prefetch: list[str] = []
+
+    def where(self, column: str | None = None, op: str = '=', value=None, 
+              **equals):
+        """Filter by column op value, keyword arguments filter by equality."""
+        conditions = list(equals.items()) if column is None else [(column, value)]
+        query = self._copy()
+        for name, x in conditions:
+            self._check_column(name)
+            op = op.upper()
+            assert op in self.OPERATORS, f"unknown operator: {op}"
+            query._where.append((name, op, x))
+        return query
+
+    def order_by(self, *columns: str):
+        """Sort by the columns, descending when prefixed with -."""
+        query = self._copy()
+        for column in columns:
+            self._check_column(column.lstrip('-'))
+            query._order.append(column)
+        return query
+
+    def prefetch(self, *names: str):
+        """Resolve these references of each page of results at once."""
+        query = self._copy()
+        query._prefetch.extend(names)
+        return query
+
+    def limit(self, count: int | None):
+        query = self._copy()
+        query._limit = count
+        return query
+
+    def offset(self, count: int):
+        query = self._copy()
+        query._offset = count
+        return query
+
+    def first(self):
+        return next(iter(self.limit(1)), None)
+
+    def all(self):
+        return list(self)
+
+    def count(self):
+        where, params = self._where_clause()
+        sql = f"SELECT COUNT(*) FROM (SELECT id FROM {self._cls.__name__}{where}"
+        sql += self._page_clause() + ")"
+        with _connection() as con:
+            return con.execute(sql, params).fetchone()[0]
+
+    def to_columns(self, *names: str):
+        """Read the columns, all with the id by default, as arrays.
+
+        Values come straight from sqlite without creating instances, so
+        unsaved changes in memory are not included. See columnexport.
+        """
+        names = names or ('id', *self._cls.description)
+        for name in names:
+            self._check_column(name)
+        # +col读出原始值, 不经转换器, 由columnexport按列转换
+        sql, params = self._select(", ".join(f'+{x}' for x in names))
+        with _connection() as con:
+            rows = con.execute(sql, params).fetchall()
+        values = list(zip(*rows)) if rows else [()] * len(names)
+
+        columns = {}
+        for name, column in zip(names, values):
+            dtype = 'INTEGER' if name == 'id' else self._cls.description[name]
+            columns[name] = to_array(
+                list(column), dtype, dtype in PropertyMeta.classes)
+        return columns
+
+    def to_numpy(self, *names: str):
+        """The columns as a numpy structured array."""
+        return to_structured(self.to_columns(*names))
+
+    def to_arrow(self, *names: str):
+        """The columns as a pyarrow table, requires pyarrow."""
+        return to_table(self.to_columns(*names))
+
+    def __iter__(self):
+        sql, params = self._select(_columns(self._cls, True))
+
+        with _connection() as con:
+            cur = con.execute(sql, params)
+            while rows := cur.fetchmany(self.PAGE_SIZE):
+                page = []
+                for row in rows:
+                    ins = self._cls.get(row[0])
+                    # 已在内存中的实例可能有未保存的修改, 以内存为准
+                    if ins is None:
+                        ins = _finish(_hydrate(self._cls, row))
+                    page.append(ins)
+                if self._prefetch:
+                    self._cls.prefetch(page, *self._prefetch)
+                yield from page
+
+    def _select(self, columns: str):
+        where, params = self._where_clause()
+        sql = f"SELECT {columns} FROM {self._cls.__name__}{where}"
+        if self._order:
+            sql += " ORDER BY " + ", ".join(
+                f"{x[1:]} DESC" if x.startswith('-') else x for x in self._order)
+        return sql + self._page_clause(), params
+
+    def _copy(self):
+        query = Query(self._cls)
+        query._where = list(self._where)
+        query._order = list(self._order)
+        query._limit = self._limit
+        query._offset = self._offset
+        query._prefetch = list(self._prefetch)
+        return query
+
+    def _check_column(self, column: str):
+        assert column == 'id' or column in self._cls.description, \
+            f"unknown column: {column}"
+
+    def _where_clause(self):
+        clauses = []
+        params = []
+        # 待删除的行仍在数据库中, 不能再创建实例
+        if self._cls.deleted:
+            clauses.append("id NOT IN (SELECT value FROM json_each(?))")
+            params.append(json.dumps(list(self._cls.deleted)))
+        for column, op, value in self._where:
+            if op in ('IN', 'NOT IN'):
+                value = list(value) #type: ignore
+                clauses.append(f"{column} {op} ({', '.join('?' * len(value))})")
+                params.extend(value)
+            elif value is None and op in ('=', '!='):
+                clauses.append(f"{column} IS {'' if op == '=' else 'NOT '}NULL")
+            else:
+                clauses.append(f"{column} {op} ?")
+                params.append(value)
+        if not clauses:
+            return "", []
+        return " WHERE " + " AND ".join(clauses), params
+
+    def _page_clause(self):
+        if self._limit is None and not self._offset:
+            return ""
+        return f" LIMIT {-1 if self._limit is None else int(self._limit)}" \
+            f" OFFSET {int(self._offset)}"
+
+# 批量修改的嵌套层数, 以及期间各实例变动的属性
+_batch_depth = 0
+_batched: dict[object, set[str]] = {}
+
+@contextmanager
+def batch():
+    """Coalesce change signals of all assignments in the block.
+
+    Each modified instance emits every <prop>_changed once, then
+    properties_changed with the set of changed names and changed once,
+    when the outermost block exits. Only for the gui thread.
+    """
+    global _batch_depth
+    _batch_depth += 1
+    try:
+        yield
+    finally:
+        _batch_depth -= 1
+        if not _batch_depth:
+            _flush_batch()
+
+def _flush_batch():
+    changes = dict(_batched)
+    _batched.clear()
+    for ins, names in changes.items():
+        for name in type(ins).description:
+            if name in names and type(ins).store is None:
+                getattr(ins, f"{name}_changed").emit()
+        ins.properties_changed.emit(names)
+        ins.changed.emit()
+
+# 数据库路径, load后查询使用, 使用Engine时查询共用其读连接
+_path = None
+_engine: 'Engine | None' = None
+
+@contextmanager
+def _connection():
+    if _engine is not None:
+        yield _engine.reader
+        return
+    assert _path is not None, "load the database first"
+    with closing(sqlite3.connect(
+        _path, detect_types=sqlite3.PARSE_DECLTYPES)) as con:
+        yield con
+
+def _references(cls):
+    """Properties referencing other classes, as (private name, class)."""
+    classes = PropertyMeta.classes
+    return [(f'_{k}', classes[v]) for k, v in cls.description.items() 
+        if v in classes]
+
+def _resolve(name: str, id: int):
+    """The instance of class name with the id, queried if not in memory."""
+    cls = PropertyMeta.classes[name]
+    ins = cls.get(id)
+    if ins is None and _path is not None:
+        ins = cls.query().where(id=id).first()
+    return ins
+
+def _columns(cls, raw_references=False):
+    # 表达式没有声明类型, +col读出引用的原始id, 不经转换器
+    references = {x[1:] for x, _ in _references(cls)} if raw_references else ()
+    return ", ".join(('id', *(f'+{x}' if x in references else x 
+        for x in cls.description)))
+
+def _hydrate(cls, row):
+    """Create the instance of a row, (id, *columns) in description order.
+
+    Values go straight into the property storage without type checks or
+    signals, call _finish once references are resolved.
+    """
+    # 先登记id, 引用自身的行可经id表找到该实例
+    ins = cls._construct(row[0], DBStatus.IDLE)
+    ins._properties.update(zip(cls.private_names, row[1:]))
+    return ins
+
+def _finish(ins):
+    convert = getattr(ins, 'convert', None)
+    if convert:
+        convert()
+    # 载入的值与数据库一致, 无需保存, __init__中的赋值也不算修改
+    if ins.db_status != DBStatus.IDLE:
+        ins.db_status = DBStatus.IDLE
+    return ins
+
+# 新建的实例是否常驻内存, 全部载入时保持所有实例, 按需载入时只保留在用的
+_pin = True
+
+def memory_stats():
+    """Live instances per class, with how many are pinned and unsaved."""
+    stats = {}
+    for cls in PropertyMeta.registry:
+        stats[cls.__name__] = {
+            'live': len(cls.inses),
+            'pinned': len(cls.pinned),
+            'dirty': len(cls.dirty),
+        }
+        if cls.store is not None:
+            stats[cls.__name__]['rows'] = len(cls.store)
+    return stats
+
+# 数据库载入, lazy时只建表, 实例由查询按需创建
+def load(path, lazy=False):
+    global _path, _engine
+    _path = path
+    _engine = None
+    with closing(sqlite3.connect(
+        path, detect_types=sqlite3.PARSE_DECLTYPES)) as con:
+        _load(con, lazy)
+
+def _load(con, lazy):
+    global _pin
+    _pin = not lazy
+    cur = con.cursor()
+    for cls in PropertyMeta.registry:
+        cols = "id INTEGER PRIMARY KEY"
+        cols += "".join([f", {col} {dtype}" 
+            for col, dtype in cls.description.items()])
+        cls_name = cls.__name__
+        cur.execute(f"CREATE TABLE IF NOT EXISTS {cls_name}({cols})")
+        for index, columns, unique in cls.indexes:
+            cur.execute(f"""
+                CREATE {'UNIQUE ' if unique else ''}INDEX IF NOT EXISTS
+                {index} ON {cls_name}({', '.join(columns)})
+            """)
+    con.commit()
+    if lazy:
+        return
+
+    # 引用列只读出id, 访问时再解析, 各表可依次载入
+    loaded = {}
+    for cls in PropertyMeta.registry:
+        inses = loaded[cls] = []
+        for row in cur.execute(
+            f"SELECT {_columns(cls, True)} FROM {cls.__name__}"):
+            # 已在内存中的实例(如convert中访问引用时查询到的)不重复创建
+            if row[0] in cls.deleted:
+                continue
+            ins = cls.get(row[0])
+            if ins is None:
+                inses.append(_hydrate(cls, row))
+            else:
+                cls.pinned.add(ins)
+
+    # convert可能访问引用, 所有表载入后再调用
+    for cls, inses in loaded.items():
+        for ins in inses:
+            _finish(ins)
+        cls.pinned.update(inses)
+
+def _row(ins, columns, references):
+    # 直接读取属性存储, 引用在快照时转为id, 写线程不访问实例
+    values = [ins._properties.get(f'_{x}') for x in columns]
+    for i in references:
+        # 未解析的引用仍是id, 不存在的引用是Dangling
+        value = values[i]
+        if value is not None:
+            values[i] = int(value) if isinstance(value, int) else value.id
+    return values
+
+def _snapshot():
+    """Collect the pending changes of all classes and mark them saved.
+
+    Returns the statements as (sql, rows) and the changes as
+    (instance, status, columns), for _restore if writing fails. For
+    deleted instances the last item tells whether it was pinned.
+    """
+    statements = []
+    changes = []
+    for cls in PropertyMeta.registry:
+        cls_name = cls.__name__
+        references = {x[1:] for x, _ in _references(cls)}
+
+        def rows(inses, columns):
+            indices = [i for i, x in enumerate(columns) if x in references]
+            return [(x.id, *_row(x, columns, indices)) for x in inses]
+
+        # adapt可能通过属性修改实例, 需在收集变动前调用
+        if getattr(cls, 'adapt', None):
             for ins in cls.inses:
-                adapt = getattr(ins, 'adapt', None)
-                if adapt:
-                    adapt()
-
-            if to_delete: 
-                cur.executemany(f"""
-                    DELETE FROM {cls_name}
-                    WHERE id = ?
-                """, [(c.id,) for c in to_delete])
-
-            if cls_name == 'Patient':
-                logger.debug(f"to insert: {len(to_insert)}, all: {len(cls.inses)}")
-            if to_insert:
-                place_holder = ('?,'*(len(cls.description)+1))[:-1]
-                cur.executemany(f"""
-                    INSERT INTO {cls_name} VALUES({place_holder})
-                """, [(x.id,)+tuple(getattr(x, p) for p in cls.description)
-                        for x in to_insert])
-
-            if to_update: 
-                columns = ", ".join([f"{p} = ?" for p in cls.description])
-                cur.executemany(f"""
-                    UPDATE {cls_name}
-                    SET {columns}
-                    where id = ?
-                """, [tuple(getattr(x, p) for p in cls.description) + (x.id,)
-                        for x in to_update])
-
-            for x in cls.inses:
-                x.db_status = DBStatus.IDLE
-
-        con.commit()
+                ins.adapt()
+
+        to_insert = []
+        to_delete = []
+        # 变动的列 -> 实例
+        to_update: dict[tuple, list] = {}
+        for x in cls.dirty:
+            match x.db_status:
+                case DBStatus.INSERT:
+                    to_insert.append(x)
+                case DBStatus.DELETE:
+                    to_delete.append(x)
+                case DBStatus.UPDATE:
+                    columns = tuple(p for p in cls.description 
+                        if p in x._changed)
+                    to_update.setdefault(columns, []).append(x)
+
+        if to_delete: 
+            statements.append((f"""
+                DELETE FROM {cls_name}
+                WHERE id = ?
+            """, [(c.id,) for c in to_delete]))
+
+        if cls_name == 'Patient':
+            logger.debug(f"to insert: {len(to_insert)}, all: {len(cls.inses)}")
+        if to_insert:
+            place_holder = ('?,'*(len(cls.description)+1))[:-1]
+            statements.append((f"""
+                INSERT INTO {cls_name} VALUES({place_holder})
+            """, rows(to_insert, tuple(cls.description))))
+
+        for columns, inses in to_update.items():
+            if not columns:
+                continue
+            # 参数依次为id和各列
+            assignments = ", ".join(
+                [f"{p} = ?{i}" for i, p in enumerate(columns, 2)])
+            statements.append((f"""
+                UPDATE {cls_name}
+                SET {assignments}
+                where id = ?1
+            """, rows(inses, columns)))
+
+        # 已删除的实例不再保留
+        for x in to_delete:
+            # 删除的实例记录是否常驻, 写入失败时恢复
+            changes.append((x, DBStatus.DELETE, x in cls.pinned))
+            cls.inses.discard(x)
+            cls.pinned.discard(x)
+            cls.dirty.discard(x)
+
+        for x in list(cls.dirty):
+            changes.append((x, x.db_status, set(x._changed)))
+            x.db_status = DBStatus.IDLE
+
+    return statements, changes
+
+def _write(con, statements):
+    with con:
+        for sql, rows in statements:
+            con.executemany(sql, rows)
+    return sum(len(rows) for _, rows in statements)
+
+def _written(changes):
+    """Forget the deleted ids of a successful write, their rows are gone."""
+    for ins, status, _ in changes:
+        if status == DBStatus.DELETE and ins.db_status == DBStatus.DELETE:
+            type(ins).deleted.discard(ins.id)
+
+def _restore(changes):
+    """Mark the changes of a failed write as pending again."""
+    for ins, status, columns in changes:
+        cls = type(ins)
+        if status == DBStatus.DELETE:
+            cls.inses.add(ins)
+            cls.dirty.add(ins)
+            if columns:
+                cls.pinned.add(ins)
+            continue
+        if ins.db_status in (DBStatus.DELETE, DBStatus.INSERT):
+            continue
+        # 写入失败的插入仍需插入, 其后的修改包含在插入中
+        ins.db_status = status
+        ins._changed |= columns
+
+# 数据库保存, 只处理变动过的实例
+def save(path):
+    statements, changes = _snapshot()
+    try:
+        with closing(sqlite3.connect(path)) as con:
+            _write(con, statements)
+    except Exception:
+        _restore(changes)
+        raise
+    _written(changes)
+
+class Engine(QObject):
+    """长期持有的数据库连接, 在后台线程中写入
+
+    commit在gui线程中对变动拍快照, 写线程按顺序提交; 查询使用读连接,
+    WAL模式下读写互不阻塞. autosave大于0时定期提交.
+    """
+    PRAGMAS = (
+        "PRAGMA journal_mode = WAL",
+        "PRAGMA synchronous = NORMAL",
+        "PRAGMA temp_store = MEMORY",
+        "PRAGMA cache_size = -65536",
+        "PRAGMA mmap_size = 268435456",
+        "PRAGMA busy_timeout = 5000",
+    )
+    # 每个连接缓存的预编译语句数
+    CACHED_STATEMENTS = 256
+
+    # 写入的行数
+    saved = Signal(int)
+    failed = Signal(str)
+
+    write_done = Signal(object)
+    write_failed = Signal(object, str)
+
+    def __init__(self, path, autosave=0, parent=None):
+        super().__init__(parent)
+
+        self._path = path
+        self._queue: queue.Queue = queue.Queue()
+        self.reader = self._connect(detect_types=sqlite3.PARSE_DECLTYPES)
+
+        self._writer = threading.Thread(target=self._run, daemon=True)
+        self._writer.start()
+
+        self._timer = QTimer(self)
+        self._timer.timeout.connect(self.commit)
+        if autosave > 0:
+            self._timer.start(autosave)
+
+        self.write_done.connect(self._on_write_done)
+        self.write_failed.connect(self._on_write_fail)
+
+    def load(self, lazy=False):
+        global _path, _engine
+        _path = self._path
+        _engine = self
+        _load(self.reader, lazy)
+
+    @Slot()
+    def commit(self):
+        """Snapshot the pending changes and write them in the background."""
+        statements, changes = _snapshot()
+        if not statements:
+            return False
+        self._queue.put((statements, changes))
+        return True
+
+    def flush(self):
+        """Commit and wait until everything is written."""
+        self.commit()
+        self._queue.join()
+
+    def close(self):
+        global _engine
+        self._timer.stop()
+        self.flush()
+        self._queue.put(None)
+        self._writer.join()
+        self.reader.close()
+        if _engine is self:
+            _engine = None
+
+    def _connect(self, **kwargs):
+        con = sqlite3.connect(self._path, check_same_thread=False,
+            cached_statements=self.CACHED_STATEMENTS, **kwargs)
+        for pragma in self.PRAGMAS:
+            con.execute(pragma)
+        return con
+
+    def _run(self):
+        con = self._connect()
+        while (job := self._queue.get()) is not None:
+            statements, changes = job
+            try:
+                count = _write(con, statements)
+                self.write_done.emit(changes)
+                self.saved.emit(count)
+            except sqlite3.Error as e:
+                logger.warning(f"save failed: {str(e)}")
+                self.write_failed.emit(changes, str(e))
+            finally:
+                self._queue.task_done()
+        self._queue.task_done()
+        con.close()
+
+    @Slot() #type: ignore
+    def _on_write_done(self, changes):
+        _written(changes)
+
+    @Slot() #type: ignore
+    def _on_write_fail(self, changes, message: str):
+        _restore(changes)
+        self.failed.emit(message)